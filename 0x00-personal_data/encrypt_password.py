@@ -1,14 +1,170 @@
 #!/usr/bin/env python3
-"""This module provides functions for hashing and validating passwords."""
+"""This module provides functions for hashing and validating passwords.
+
+The bcrypt cost factor is calibrated once per process: the highest cost
+whose hash time fits BCRYPT_TARGET_MS (default 100) on this machine, and
+never below BCRYPT_MIN_COST (default 12, the bcrypt.gensalt() default
+used before) nor above BCRYPT_MAX_COST (default 16). BCRYPT_COST sets a
+fixed cost instead. Hashes are only ever rehashed to a higher cost.
+When even BCRYPT_MIN_COST is over the budget, the minimum wins: a warning
+is logged and the calibration reports budget_met False.
+"""
+
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from math import floor, log2
+from threading import Lock
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 import bcrypt
 
+_calibration = {}
+_calibration_lock = Lock()
+logger = logging.getLogger(__name__)
+
+
+def _measure_ms(cost: int, runs: int = 3) -> float:
+    """Returns the fastest of runs bcrypt hash times at cost, in ms."""
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", bcrypt.gensalt(cost))
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate(target_ms: Optional[float] = None) -> dict:
+    """Picks the bcrypt cost meeting the per-hash budget and returns
+    the calibration: cost, budget, whether the cost meets it (None for
+    a fixed BCRYPT_COST) and measured times per cost."""
+    if target_ms is None:
+        target_ms = float(os.getenv("BCRYPT_TARGET_MS", 100))
+    min_cost = int(os.getenv("BCRYPT_MIN_COST", 12))
+    max_cost = int(os.getenv("BCRYPT_MAX_COST", 16))
+    with _calibration_lock:
+        if os.getenv("BCRYPT_COST"):
+            cost, measurements = int(os.getenv("BCRYPT_COST")), {}
+            budget_met = None
+        else:
+            base = _measure_ms(min_cost)
+            measurements = {min_cost: base}
+            steps = floor(log2(target_ms / base)) if base > 0 else 0
+            cost = min(max(min_cost + steps, min_cost), max_cost)
+            # each cost step doubles the work: confirm the estimate
+            while cost > min_cost:
+                measurements[cost] = _measure_ms(cost, runs=1)
+                if measurements[cost] <= target_ms:
+                    break
+                cost -= 1
+            budget_met = measurements[cost] <= target_ms
+            if not budget_met:
+                logger.warning("bcrypt cost %d, the minimum, takes %.0f ms:"
+                               " over the %.0f ms budget", cost,
+                               measurements[cost], target_ms)
+        _calibration.clear()
+        _calibration.update(cost=cost, target_ms=target_ms,
+                            budget_met=budget_met,
+                            measurements_ms=measurements)
+        return dict(_calibration)
+
+
+def calibration() -> dict:
+    """Returns the calibration, calibrating on first use."""
+    if not _calibration:
+        calibrate()
+    return dict(_calibration)
+
 
 def hash_password(password: str) -> bytes:
     """Hashes a password and returns it as a byte string."""
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    cost = calibration()["cost"]
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(cost))
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """Checks if a hash was made with a lower cost than the current one."""
+    parts = hashed_password.split(b"$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return True
+    return int(parts[2]) < calibration()["cost"]
+
+
+def is_valid(hashed_password: bytes, password: str,
+             on_rehash: Optional[Callable[[bytes], None]] = None) -> bool:
+    """Checks if a password matches the hashed password.
+
+    When it does and the hash used a lower cost than the calibrated one,
+    on_rehash is called with a new hash, for the caller to store."""
+    if not bcrypt.checkpw(password.encode("utf-8"), hashed_password):
+        return False
+    if on_rehash is not None and needs_rehash(hashed_password):
+        on_rehash(hash_password(password))
+    return True
+
+
+def _hash_chunk(passwords: List[str], cost: int) -> List[bytes]:
+    """Hashes a chunk of passwords at cost, in a worker process."""
+    return [bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(cost))
+            for password in passwords]
+
+
+def _verify_chunk(pairs: List[Tuple[bytes, str]]) -> List[bool]:
+    """Checks a chunk of (hashed_password, password), in a worker."""
+    return [bcrypt.checkpw(password.encode("utf-8"), hashed_password)
+            for hashed_password, password in pairs]
+
+
+def _fan_out(func: Callable, items: Iterable, chunk_size: int,
+             workers: Optional[int], progress: Optional[Callable[[int], None]],
+             *args) -> Iterator:
+    """Runs func over chunks of items in a process pool and yields the
+    results in input order. At most two chunks per worker are in flight,
+    so the input is consumed lazily and memory stays bounded."""
+    workers = workers or os.cpu_count() or 1
+    items = iter(items)
+    pending = deque()
+    done = 0
+    pool = ProcessPoolExecutor(workers)
+    try:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(islice(items, chunk_size))
+                if not chunk:
+                    break
+                pending.append(pool.submit(func, chunk, *args))
+            if not pending:
+                return
+            results = pending.popleft().result()
+            done += len(results)
+            if progress is not None:
+                progress(done)
+            yield from results
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def hash_passwords(passwords: Iterable[str], chunk_size: int = 64,
+                   workers: Optional[int] = None,
+                   progress: Optional[Callable[[int], None]] = None
+                   ) -> Iterator[bytes]:
+    """Hashes many passwords over all cores and yields the hashes in
+    order. progress is called with the number of passwords done after
+    each chunk."""
+    cost = calibration()["cost"]
+    return _fan_out(_hash_chunk, passwords, chunk_size, workers, progress,
+                    cost)
 
 
-def is_valid(hashed_password: bytes, password: str) -> bool:
-    """Checks if a password matches the hashed password."""
-    return bcrypt.checkpw(password.encode("utf-8"), hashed_password)
+def verify_many(pairs: Iterable[Tuple[bytes, str]], chunk_size: int = 64,
+                workers: Optional[int] = None,
+                progress: Optional[Callable[[int], None]] = None
+                ) -> Iterator[bool]:
+    """Checks many (hashed_password, password) pairs over all cores and
+    yields the results in order. progress is called with the number of
+    pairs done after each chunk."""
+    return _fan_out(_verify_chunk, pairs, chunk_size, workers, progress)
@@ -1,15 +1,33 @@
 #!/usr/bin/env python3
 """This module handles logging and data privacy."""
 
+import copy
 import logging
 import re
 import mysql.connector
 import os
-from typing import List
+import threading
+from functools import lru_cache
+from weakref import WeakKeyDictionary
+from typing import List, Sequence
+
+# Attributes every LogRecord has; the others come from `extra`
+RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {
+        "message", "asctime"}
 
 
 class RedactingFormatter(logging.Formatter):
-    """Formatter that redacts sensitive information."""
+    """Formatter that redacts sensitive information.
+
+    Only the formatted output is redacted: the record is formatted
+    through a shallow copy holding the redacted message, so the other
+    handlers of the record see it unchanged. The redacted message is
+    cached per record, so a record formatted again (by another handler
+    sharing this formatter) is not redacted twice, and records dropped
+    by level are never redacted at all. Attributes passed with `extra`
+    whose names are in fields are replaced by the redaction too.
+    """
 
     RED = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
@@ -18,13 +36,75 @@ class RedactingFormatter(logging.Formatter):
     def __init__(self, fields: List[str]):
         super().__init__(self.FORMAT)
         self.fields = fields
+        self.redactor = get_redactor(tuple(fields), self.RED, self.SEP)
+        self.extra_fields = tuple(field for field in fields
+                                  if field not in RECORD_ATTRIBUTES)
+        self._redacted = WeakKeyDictionary()
+        self._lock = threading.Lock()
 
     def format(self, record: logging.LogRecord) -> str:
         """Redacts sensitive data in log records."""
 
-        record.msg = filter_datum(self.fields, self.RED,
-                                  record.getMessage(), self.SEP)
-        return super().format(record)
+        redacted = copy.copy(record)
+        redacted.msg = self.redacted_message(record)
+        redacted.args = None
+        for field in self.extra_fields:
+            if field in record.__dict__:
+                setattr(redacted, field, self.RED)
+        return super().format(redacted)
+
+    def redacted_message(self, record: logging.LogRecord) -> str:
+        """Returns the redacted message of a record, redacting it only
+        on the first call for the record."""
+        with self._lock:
+            cached = self._redacted.get(record)
+        if cached is not None and cached[0] is record.msg \
+                and cached[1] is record.args:
+            return cached[2]
+        message = self.redactor.redact(record.getMessage())
+        with self._lock:
+            self._redacted[record] = (record.msg, record.args, message)
+        return message
+
+
+class Redactor:
+    """Redacts the values of fields in "field=value<separator>" text.
+
+    The pattern is compiled once: a single alternation of the field
+    names capturing the name, with the value matched up to the
+    separator. Each match is replaced by the captured name and the
+    prebuilt "=<redaction>" suffix. Output is identical to filter_datum;
+    as there, field names are regular expressions (a name with a
+    top-level "|" is the only case where the two differ).
+    """
+
+    def __init__(self, fields: Sequence[str], redaction: str,
+                 separator: str):
+        self.fields = tuple(fields)
+        self.redaction = redaction
+        self.separator = separator
+        suffix = "=" + redaction
+        if self.fields:
+            self.pattern = re.compile("({})=[^{}]*".format(
+                "|".join(self.fields), separator))
+            self._replace = lambda match: match.group(1) + suffix
+        else:
+            # filter_datum joins no field into an empty pattern, which
+            # matches everywhere
+            self.pattern = re.compile("")
+            self._replace = lambda match: suffix
+
+    def redact(self, message: str) -> str:
+        """Returns message with the values of the fields redacted."""
+        return self.pattern.sub(self._replace, message)
+
+    __call__ = redact
+
+
+@lru_cache(maxsize=128)
+def get_redactor(fields: tuple, redaction: str, separator: str) -> Redactor:
+    """Returns the shared Redactor of (fields, redaction, separator)."""
+    return Redactor(fields, redaction, separator)
 
 
 def filter_datum(fields: List[str], redaction: str, message: str, separator: str) -> str:
@@ -41,8 +121,7 @@ def filter_datum(fields: List[str], redaction: str, message: str, separator: str
         Redacted log message.
     """
 
-    pattern = "|".join([f"{field}=([^{separator}]*)" for field in fields])
-    return re.sub(pattern, lambda m: f"{m.group().split('=')[0]}={redaction}", message)
+    return get_redactor(tuple(fields), redaction, separator).redact(message)
 
 
 def get_logger() -> logging.Logger:
@@ -3,31 +3,40 @@
 Route module for the API
 """
 from os import getenv
+from time import perf_counter
 from api.v1.views import app_views
-from api.v1.auth.auth import Auth
+from api.v1.auth import auth_from_env, EXCLUDED_PATHS
 from api.v1.auth.session_auth import SessionAuth
-from api.v1.auth.basic_auth import BasicAuth
-from flask import Flask, jsonify, abort, request
+from api.v1.compression import compressor
+from api.v1.metrics import metrics
+from api.v1.profiler import profiler
+from models.base import Base, DATA
+from flask import Flask, jsonify, abort, request, g
 from flask_cors import (CORS, cross_origin)
 
 
 app = Flask(__name__)
 app.register_blueprint(app_views)
 CORS(app, resources={r"/api/v1/*": {"origins": "*"}})
-auth = None
-
-if getenv("AUTH_TYPE") == "auth":
-    auth = Auth()
-elif getenv("AUTH_TYPE") == "basic_auth":
-    auth = BasicAuth()
-elif getenv("AUTH_TYPE") == "session_auth":
-    auth = SessionAuth()
-elif getenv('AUTH_TYPE') == 'session_exp_auth':
-    from api.v1.auth.session_exp_auth import SessionExpAuth
-    auth = SessionExpAuth()
-elif getenv('AUTH_TYPE') == 'session_db_auth':
-    from api.v1.auth.session_db_auth import SessionDBAuth
-    auth = SessionDBAuth()
+auth = auth_from_env()
+
+if metrics.enabled:
+    for endpoint, view in list(app.view_functions.items()):
+        app.view_functions[endpoint] = metrics.instrument_view(endpoint, view)
+    metrics.instrument(Base, 'search', 'models_operation_duration_seconds',
+                       {'op': 'search'})
+    metrics.instrument(Base, 'save_to_file',
+                       'models_operation_duration_seconds',
+                       {'op': 'save_to_file'})
+    metrics.instrument(Base, 'save_many', 'models_operation_duration_seconds',
+                       {'op': 'save_many'})
+    metrics.gauge('models_store_objects', lambda: [
+        ({'model': name}, len(objs)) for name, objs in DATA.items()])
+    if isinstance(auth, SessionAuth):
+        metrics.count_results(type(auth), 'user_id_for_session_id',
+                              'api_session_lookups_total')
+        metrics.gauge('api_session_store_size', lambda: [
+            ({}, len(SessionAuth.user_id_by_session_id))])
 
 
 @app.errorhandler(404)
@@ -48,26 +57,80 @@ def forbidden(error) -> str:
     return jsonify({"error": "Forbidden"}), 403
 
 
+@app.before_request
+def start_profiling() -> None:
+    """
+    Start profiling the request when the profiler selects it.
+    Registered first so the auth pipeline is part of the profile.
+    """
+    if profiler.active:
+        handle = profiler.start(request.headers)
+        if handle is not None:
+            g.profile = handle
+
+
 @app.before_request
 def before_request() -> None:
     """
     Execute before each request to check authorization.
     Abort the request with appropriate error code if authentication fails.
     """
-    authorized_list = [
-        '/api/v1/status/','/api/v1/unauthorized/','/api/v1/forbidden/',
-        '/api/v1/auth_session/login/']
+    if metrics.enabled:
+        g.request_start = perf_counter()
     if auth:
-        if auth.require_auth(request.path, authorized_list):
+        with metrics.timed('api_before_request_duration_seconds'):
+            with metrics.timed('api_auth_step_duration_seconds',
+                               {'step': 'require_auth'}):
+                required = auth.require_auth(request.path, EXCLUDED_PATHS)
+            if not required:
+                metrics.inc('api_auth_outcomes_total', {'outcome': 'skipped'})
+                return
             if auth.authorization_header(
                     request) is None and auth.session_cookie(request) is None:
+                metrics.inc('api_auth_outcomes_total', {'outcome': '401'})
                 abort(401)
-            request.current_user = auth.current_user(request)
-            if auth.current_user(request) is None:
-                abort(403)
+            with metrics.timed('api_auth_step_duration_seconds',
+                               {'step': 'current_user'}):
+                request.current_user = auth.current_user(request)
             if request.current_user is None:
+                metrics.inc('api_auth_outcomes_total', {'outcome': '403'})
                 abort(403)
+            metrics.inc('api_auth_outcomes_total', {'outcome': 'ok'})
+
+
+@app.after_request
+def after_request(response):
+    """
+    Record the total latency of the request when metrics are enabled.
+    """
+    if metrics.enabled and 'request_start' in g:
+        metrics.observe('api_request_duration_seconds',
+                        perf_counter() - g.request_start,
+                        {'method': request.method,
+                         'endpoint': request.endpoint or 'none',
+                         'status': response.status_code})
+    return response
+
 
+@app.after_request
+def compress_response(response):
+    """
+    Compress large responses with the best coding the client accepts.
+    Registered after the metrics hook so it runs first and its cost is
+    part of the recorded latency.
+    """
+    return compressor(response, request.accept_encodings)
+
+
+@app.teardown_request
+def stop_profiling(error=None) -> None:
+    """
+    Stop profiling the request and aggregate it by route and auth type.
+    """
+    handle = g.pop('profile', None)
+    if handle is not None:
+        route = request.url_rule.rule if request.url_rule else request.path
+        profiler.stop(handle, route, type(auth).__name__ if auth else 'none')
 
 if __name__ == "__main__":
     host = getenv("API_HOST", "0.0.0.0")
@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point for the API.
+
+Serves the routes of api.v1.app, with the same auth pipeline, error
+handlers and view helpers, natively on asyncio: idle keep-alive clients
+cost no thread, and password hashing and file storage run in the
+default executor. ETags, compression and the request metrics are
+recorded by the Flask app only; /metrics renders what this process holds.
+
+Request bodies larger than API_MAX_BODY_SIZE bytes (default 8 MiB) are
+refused with 413, before being read in full.
+
+Run with any ASGI server, e.g. `uvicorn api.v1.asgi:app`.
+"""
+import asyncio
+import json
+import re
+from functools import partial
+from http.cookies import SimpleCookie
+from os import getenv
+from typing import Callable, Tuple, Union
+from urllib.parse import parse_qsl
+from api.v1.auth import auth_from_env, EXCLUDED_PATHS
+from api.v1.auth.basic_auth import BasicAuth
+from api.v1.auth.session_db_auth import SessionDBAuth
+from api.v1.metrics import metrics
+from api.v1.profiler import profiler
+from api.v1.views.profiler import apply_settings
+from api.v1.views.users import (NDJSON_MIMETYPE, create_users, list_users,
+                                ndjson_items, new_user, requested_fields,
+                                search_page, serializer, stream_users,
+                                update_fields)
+from models.user import User
+
+
+auth = auth_from_env()
+# auth classes whose current_user hashes a password or reads a file
+BLOCKING_AUTH = (BasicAuth, SessionDBAuth)
+
+ERRORS = {401: "Unauthorized", 403: "Forbidden", 404: "Not found",
+          405: "Method not allowed", 413: "Payload too large"}
+MAX_BODY_SIZE = int(getenv('API_MAX_BODY_SIZE', 8 * 1024 * 1024))
+
+
+class HTTPError(Exception):
+    """
+    Aborts the request with an HTTP error status.
+    """
+
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+class Headers(dict):
+    """
+    Request headers with case-insensitive `get`.
+    """
+
+    def get(self, key: str, default=None):
+        return super().get(key.lower(), default)
+
+
+class Request:
+    """
+    The subset of the Flask request interface used by the auth classes
+    and the views: path, method, headers, cookies, args, form, JSON.
+    """
+
+    def __init__(self, scope: dict, body: bytes):
+        """
+        Builds the request from an ASGI HTTP scope and its body.
+        """
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'')
+        self.headers = Headers(
+            (k.decode('latin-1').lower(), v.decode('latin-1'))
+            for k, v in scope.get('headers', []))
+        self.args = dict(parse_qsl(self.query_string.decode('latin-1'),
+                                   keep_blank_values=True))
+        self.body = body
+        self.current_user = None
+        self.rule = None
+        cookie = SimpleCookie()
+        try:
+            cookie.load(self.headers.get('cookie', ''))
+        except Exception:
+            pass
+        self.cookies = {name: morsel.value for name, morsel in cookie.items()}
+
+    @property
+    def mimetype(self) -> str:
+        """ The media type of the body, without parameters """
+        return self.headers.get('content-type', '').split(';')[0].strip()
+
+    @property
+    def form(self) -> dict:
+        """ The URL encoded form fields of the body """
+        if self.mimetype != 'application/x-www-form-urlencoded':
+            return {}
+        return dict(parse_qsl(self.body.decode('utf-8'),
+                              keep_blank_values=True))
+
+    def get_json(self):
+        """ The JSON body, or None if it is missing, invalid or not
+        declared as JSON """
+        mimetype = self.mimetype
+        if mimetype != 'application/json' and not (
+                mimetype.startswith('application/')
+                and mimetype.endswith('+json')):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    def accepts_ndjson(self) -> bool:
+        """ Whether the client prefers NDJSON over JSON """
+        accept = self.headers.get('accept', '')
+        return NDJSON_MIMETYPE in accept and 'application/json' not in accept
+
+
+class Response:
+    """
+    An HTTP response with a bytes body or an iterator of str chunks.
+    """
+
+    def __init__(self, body=b'', status: int = 200,
+                 content_type: str = 'application/json'):
+        self.body = body
+        self.status = status
+        self.headers = [('content-type', content_type)]
+
+    async def send(self, send: Callable) -> None:
+        """
+        Sends the response through an ASGI send callable.
+        """
+        headers = [(k.encode('latin-1'), v.encode('latin-1'))
+                   for k, v in self.headers]
+        if isinstance(self.body, bytes):
+            headers.append((b'content-length',
+                            str(len(self.body)).encode()))
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': headers})
+        if isinstance(self.body, bytes):
+            await send({'type': 'http.response.body', 'body': self.body})
+            return
+        for chunk in self.body:
+            await send({'type': 'http.response.body',
+                        'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def jsonify(data, status: int = 200) -> Response:
+    """
+    Builds a JSON response.
+    """
+    return Response(json.dumps(data).encode('utf-8') + b'\n', status)
+
+
+def abort(status: int):
+    """
+    Aborts the request with an HTTP error status.
+    """
+    raise HTTPError(status)
+
+
+async def run_blocking(func: Callable, *args):
+    """
+    Runs a blocking call (hashing, file storage) in the default executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args))
+
+
+ROUTES = []
+
+
+def route(path: str, methods: Tuple[str, ...] = ('GET',)):
+    """
+    Registers a handler for /api/v1<path>, with or without a trailing
+    slash. Static routes must be registered before parametrized ones.
+    """
+    pattern = re.compile('^/api/v1{}/?$'.format(
+        re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', path.rstrip('/'))))
+    rule = '/api/v1' + path
+
+    def decorator(handler: Callable) -> Callable:
+        ROUTES.append((pattern, methods, handler, rule))
+        return handler
+    return decorator
+
+
+async def before_request(request: Request) -> None:
+    """
+    Checks authorization like api.v1.app.before_request.
+    """
+    if auth is None or not auth.require_auth(request.path, EXCLUDED_PATHS):
+        return
+    if auth.authorization_header(request) is None \
+            and auth.session_cookie(request) is None:
+        abort(401)
+    if isinstance(auth, BLOCKING_AUTH):
+        request.current_user = await run_blocking(auth.current_user, request)
+    else:
+        request.current_user = auth.current_user(request)
+    if request.current_user is None:
+        abort(403)
+
+
+async def dispatch(request: Request) -> Response:
+    """
+    Runs the auth pipeline and the handler matching the request.
+    """
+    allowed = False
+    for pattern, methods, handler, rule in ROUTES:
+        match = pattern.match(request.path)
+        if match is None:
+            continue
+        if request.method not in methods:
+            allowed = True
+            continue
+        request.rule = rule
+        await before_request(request)
+        return await handler(request, **match.groupdict())
+    await before_request(request)
+    abort(405 if allowed else 404)
+
+
+async def read_body(scope: dict, receive: Callable) -> bytes:
+    """
+    Receives the request body, up to MAX_BODY_SIZE bytes.
+
+    Raises:
+        HTTPError: 413 as soon as the declared Content-Length or the
+            bytes received exceed MAX_BODY_SIZE.
+    """
+    for name, value in scope.get('headers', []):
+        if name.lower() == b'content-length' and value.isdigit() \
+                and int(value) > MAX_BODY_SIZE:
+            abort(413)
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            abort(413)
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+async def app(scope: dict, receive: Callable, send: Callable) -> None:
+    """
+    The ASGI application.
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    try:
+        body = await read_body(scope, receive)
+    except HTTPError as e:
+        await jsonify({"error": ERRORS[e.status]}, e.status).send(send)
+        return
+    request = Request(scope, body)
+    # the profile also covers the coroutines interleaved with this one
+    handle = profiler.start(request.headers) if profiler.active else None
+    try:
+        response = await dispatch(request)
+    except HTTPError as e:
+        response = jsonify({"error": ERRORS.get(e.status, "Error")}, e.status)
+    finally:
+        if handle is not None:
+            profiler.stop(handle, request.rule or request.path,
+                          type(auth).__name__ if auth else 'none')
+    if request.headers.get('origin') is not None:
+        response.headers.append(('access-control-allow-origin', '*'))
+    await response.send(send)
+
+
+def paginated(body: Union[list, dict]) -> Response:
+    """
+    Builds the JSON response of a listing, see api.v1.views.users.
+    """
+    response = jsonify(body)
+    if isinstance(body, dict) and body.get('next') is not None:
+        response.headers.append(('link', '<{}>; rel="next"'.format(
+            body['next'])))
+    return response
+
+
+def base_url(request: Request) -> str:
+    """
+    Builds the URL of the request, without query string.
+    """
+    return "http://{}{}".format(request.headers.get('host', 'localhost'),
+                                request.path)
+
+
+@route('/status')
+async def get_status(request: Request) -> Response:
+    """ GET /api/v1/status """
+    return jsonify({"status": "OK"})
+
+
+@route('/stats')
+async def get_stats(request: Request) -> Response:
+    """ GET /api/v1/stats """
+    return jsonify({"users": User.count()})
+
+
+@route('/unauthorized')
+async def handle_unauthorized(request: Request) -> Response:
+    """ GET /api/v1/unauthorized """
+    abort(401)
+
+
+@route('/forbidden')
+async def handle_forbidden(request: Request) -> Response:
+    """ GET /api/v1/forbidden """
+    abort(403)
+
+
+@route('/metrics')
+async def get_metrics(request: Request) -> Response:
+    """ GET /api/v1/metrics, 404 unless API_METRICS is set """
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render().encode('utf-8'),
+                    content_type='text/plain; version=0.0.4')
+
+
+@route('/users/me')
+async def get_authenticated_user(request: Request) -> Response:
+    """ GET /api/v1/users/me """
+    if request.current_user is None:
+        abort(404)
+    try:
+        serialize = serializer(requested_fields(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    return jsonify(serialize(request.current_user))
+
+
+@route('/users/search')
+async def search_users(request: Request) -> Response:
+    """ GET /api/v1/users/search?email_prefix= """
+    try:
+        return paginated(search_page(request.args, base_url(request)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+
+
+@route('/users/batch', methods=('POST',))
+async def users_batch(request: Request) -> Response:
+    """ POST /api/v1/users/batch """
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = ndjson_items(request.body.splitlines())
+    else:
+        items = request.get_json()
+        if not isinstance(items, list):
+            return jsonify({'error': "Wrong format"}, 400)
+    body, status = await run_blocking(create_users, items)
+    return jsonify(body, status)
+
+
+@route('/users', methods=('GET', 'POST'))
+async def users(request: Request) -> Response:
+    """ GET /api/v1/users and POST /api/v1/users """
+    if request.method == 'POST':
+        return await create_user(request)
+    try:
+        serialize = serializer(requested_fields(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    ndjson = request.accepts_ndjson()
+    if ndjson or request.args.get('stream', '').lower() in ('1', 'true'):
+        return Response(stream_users(ndjson, serialize),
+                        content_type=NDJSON_MIMETYPE if ndjson
+                        else 'application/json')
+    try:
+        return paginated(list_users(request.args, serialize,
+                                    base_url(request)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+
+
+async def create_user(request: Request) -> Response:
+    """ POST /api/v1/users """
+    def build() -> User:
+        user = new_user(request.get_json())
+        user.save()
+        return user
+    try:
+        user = await run_blocking(build)
+        return jsonify(user.to_json(), 201)
+    except ValueError as e:
+        error_msg = str(e)
+    except Exception as e:
+        error_msg = "Can't create User: {}".format(e)
+    return jsonify({'error': error_msg}, 400)
+
+
+@route('/users/<user_id>', methods=('GET', 'PUT', 'DELETE'))
+async def one_user(request: Request, user_id: str) -> Response:
+    """ GET, PUT and DELETE /api/v1/users/<user_id> """
+    user = User.get(user_id)
+    if user is None:
+        abort(404)
+    if request.method == 'DELETE':
+        await run_blocking(user.remove)
+        return jsonify({})
+    if request.method == 'PUT':
+        try:
+            update_fields(user, request.get_json())
+        except ValueError as e:
+            return jsonify({'error': str(e)}, 400)
+        await run_blocking(user.save)
+        return jsonify(user.to_json())
+    try:
+        serialize = serializer(requested_fields(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    return jsonify(serialize(user))
+
+
+@route('/profiler', methods=('GET', 'PUT'))
+async def profiler_settings(request: Request) -> Response:
+    """ GET and PUT /api/v1/profiler """
+    if request.method == 'PUT':
+        if not profiler.control:
+            abort(404)
+        try:
+            return jsonify(apply_settings(request.get_json()))
+        except ValueError as e:
+            return jsonify({'error': str(e)}, 400)
+    return jsonify({"settings": profiler.settings(),
+                    "profiles": profiler.summary()})
+
+
+@route('/profiler/dump', methods=('POST',))
+async def profiler_dump(request: Request) -> Response:
+    """ POST /api/v1/profiler/dump """
+    if not profiler.control:
+        abort(404)
+    return jsonify({"files": await run_blocking(profiler.dump)})
+
+
+@route('/auth_session/login', methods=('POST',))
+async def session_login(request: Request) -> Response:
+    """ POST /api/v1/auth_session/login """
+    form = request.form
+    user_email = form.get('email')
+    user_password = form.get('password')
+    if not user_email:
+        return jsonify({"error": "email missing"}, 400)
+    if not user_password:
+        return jsonify({"error": "password missing"}, 400)
+    users_found = User.search({'email': user_email})
+    if not users_found:
+        return jsonify({"error": "no user found for this email"}, 404)
+    user = users_found[0]
+    if not await run_blocking(user.is_valid_password, user_password):
+        return jsonify({"error": "wrong password"}, 401)
+    session_id = await run_blocking(auth.create_session, user.id)
+    response = jsonify(user.to_json())
+    response.headers.append(('set-cookie', '{}={}; Path=/'.format(
+        getenv('SESSION_NAME'), session_id)))
+    return response
+
+
+@route('/auth_session/logout', methods=('DELETE',))
+async def session_logout(request: Request) -> Response:
+    """ DELETE /api/v1/auth_session/logout """
+    if await run_blocking(auth.destroy_session, request):
+        return jsonify({})
+    abort(404)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=getenv("API_HOST", "0.0.0.0"),
+                port=int(getenv("API_PORT", "5000")))
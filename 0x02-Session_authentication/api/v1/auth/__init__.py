@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Authentication package
+"""
+from os import getenv
+
+# paths served without authentication
+EXCLUDED_PATHS = [
+    '/api/v1/status/', '/api/v1/unauthorized/', '/api/v1/forbidden/',
+    '/api/v1/auth_session/login/', '/api/v1/metrics/']
+
+
+def auth_from_env():
+    """
+    Instantiates the auth class selected by the AUTH_TYPE environment
+    variable.
+
+    Returns:
+        Auth: The auth instance, or None if AUTH_TYPE is unset or unknown.
+    """
+    auth_type = getenv("AUTH_TYPE")
+    if auth_type == "auth":
+        from api.v1.auth.auth import Auth
+        return Auth()
+    if auth_type == "basic_auth":
+        from api.v1.auth.basic_auth import BasicAuth
+        return BasicAuth()
+    if auth_type == "session_auth":
+        from api.v1.auth.session_auth import SessionAuth
+        return SessionAuth()
+    if auth_type == "session_exp_auth":
+        from api.v1.auth.session_exp_auth import SessionExpAuth
+        return SessionExpAuth()
+    if auth_type == "session_db_auth":
+        from api.v1.auth.session_db_auth import SessionDBAuth
+        return SessionDBAuth()
+    return None
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Compression module: gzip (and brotli, when installed) response
+compression negotiated with Accept-Encoding.
+"""
+import zlib
+from os import getenv
+from typing import Iterable, Iterator, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson',
+                          'text/plain', 'text/html', 'text/csv')
+
+
+class _GzipEncoder:
+    """
+    Incremental gzip encoder.
+    """
+
+    def __init__(self, level: int):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        """ Compresses a chunk and flushes it so it can be sent now """
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """ Ends the stream """
+        return self._z.flush()
+
+
+class _BrotliEncoder:
+    """
+    Incremental brotli encoder.
+    """
+
+    def __init__(self, quality: int):
+        self._b = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        """ Compresses a chunk and flushes it so it can be sent now """
+        return self._b.process(data) + self._b.flush()
+
+    def finish(self) -> bytes:
+        """ Ends the stream """
+        return self._b.finish()
+
+
+class Compressor:
+    """
+    after_request hook compressing responses.
+
+    Environment:
+        COMPRESS: set to 0 to disable compression.
+        COMPRESS_LEVEL: gzip level, 1 to 9 (default 6).
+        COMPRESS_BROTLI_QUALITY: brotli quality, 0 to 11 (default 4).
+        COMPRESS_MIN_SIZE: smaller bodies are sent raw (default 1024).
+    """
+
+    def __init__(self):
+        """
+        Initializes the settings from environment variables.
+        """
+        self.enabled = getenv('COMPRESS', '1').lower() not in ('0', 'false')
+        self.level = int(getenv('COMPRESS_LEVEL', 6))
+        self.brotli_quality = int(getenv('COMPRESS_BROTLI_QUALITY', 4))
+        self.min_size = int(getenv('COMPRESS_MIN_SIZE', 1024))
+
+    def negotiate(self, accept_encodings) -> Optional[str]:
+        """
+        Picks the content coding to use.
+
+        Args:
+            accept_encodings: The parsed Accept-Encoding header.
+
+        Returns:
+            str: 'br', 'gzip' or None for no compression.
+        """
+        offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+        best = accept_encodings.best_match(offered)
+        if best is None or accept_encodings[best] <= 0:
+            return None
+        return best
+
+    def encoder(self, coding: str):
+        """
+        Returns a new incremental encoder for a content coding.
+        """
+        if coding == 'br':
+            return _BrotliEncoder(self.brotli_quality)
+        return _GzipEncoder(self.level)
+
+    def __call__(self, response, accept_encodings):
+        """
+        Compresses the response in place when it is worth it.
+
+        Args:
+            response: The Flask response.
+            accept_encodings: The parsed Accept-Encoding of the request.
+
+        Returns:
+            The response.
+        """
+        if not self.enabled or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        if not 200 <= response.status_code < 300 \
+                or response.status_code in (204, 206) \
+                or 'Content-Encoding' in response.headers \
+                or response.direct_passthrough:
+            return response
+        if not response.is_streamed \
+                and response.calculate_content_length() < self.min_size:
+            return response
+        coding = self.negotiate(accept_encodings)
+        if coding is None:
+            return response
+
+        encoder = self.encoder(coding)
+        if response.is_streamed:
+            response.response = _compress_stream(response.iter_encoded(),
+                                                 encoder)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            response.set_data(encoder.compress(data) + encoder.finish())
+        response.headers['Content-Encoding'] = coding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            # the bytes differ from the identity representation
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def _compress_stream(chunks: Iterable[bytes], encoder) -> Iterator[bytes]:
+    """
+    Compresses a streamed body chunk by chunk, flushing after each one
+    so the client receives data as soon as it is produced.
+    """
+    for chunk in chunks:
+        data = encoder.compress(chunk)
+        if data:
+            yield data
+    yield encoder.finish()
+
+
+compressor = Compressor()
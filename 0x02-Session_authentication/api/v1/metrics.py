@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Metrics module for request latency histograms and counters,
+exposed in the Prometheus text format.
+"""
+from functools import wraps
+from os import getenv
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Iterable, Tuple
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _NullTimer:
+    """
+    Context manager used when metrics are disabled: does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    """
+    Context manager observing the elapsed time of its block.
+    """
+
+    def __init__(self, metrics: 'Metrics', name: str, labels: dict):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self._metrics.observe(self._name, perf_counter() - self._start,
+                              self._labels)
+        return False
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed upper bounds, as Prometheus expects.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Records one observation.
+
+        Args:
+            value (float): The observed value, in seconds.
+        """
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _label_key(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    """
+    Turns a labels dictionary into a hashable, ordered key.
+    """
+    if not labels:
+        return ()
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: Tuple[Tuple[str, str], ...], extra: str = '') -> str:
+    """
+    Formats a label key as a Prometheus label set.
+    """
+    parts = ['{}="{}"'.format(k, v.replace('\\', '\\\\')
+                              .replace('"', '\\"').replace('\n', '\\n'))
+             for k, v in key]
+    if extra:
+        parts.append(extra)
+    if not parts:
+        return ''
+    return '{' + ','.join(parts) + '}'
+
+
+class Metrics:
+    """
+    Registry of counters, histograms and gauges.
+
+    When disabled every recording method returns immediately, and
+    nothing is instrumented, so the overhead is a single attribute check.
+    """
+
+    def __init__(self, enabled: bool = False):
+        """
+        Initializes an empty registry.
+
+        Args:
+            enabled (bool): Whether metrics are recorded.
+        """
+        self.enabled = enabled
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+
+    def describe(self, name: str, kind: str, text: str) -> None:
+        """
+        Registers the type and help text of a metric.
+
+        Args:
+            name (str): The metric name.
+            kind (str): One of 'counter', 'histogram' or 'gauge'.
+            text (str): The help text.
+        """
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, labels: dict = None, value: float = 1) -> None:
+        """
+        Increments a counter.
+
+        Args:
+            name (str): The counter name.
+            labels (dict): The label values.
+            value (float): The increment.
+        """
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, labels: dict = None) -> None:
+        """
+        Records a latency observation into a histogram.
+
+        Args:
+            name (str): The histogram name.
+            seconds (float): The observed latency.
+            labels (dict): The label values.
+        """
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def timed(self, name: str, labels: dict = None):
+        """
+        Returns a context manager timing its block into a histogram.
+
+        Args:
+            name (str): The histogram name.
+            labels (dict): The label values.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def gauge(self, name: str,
+              collect: Callable[[], Iterable[Tuple[dict, float]]]) -> None:
+        """
+        Registers a gauge evaluated lazily when metrics are rendered.
+
+        Args:
+            name (str): The gauge name.
+            collect (callable): Returns (labels, value) pairs.
+        """
+        self._gauges[name] = collect
+
+    def instrument(self, owner: type, attr: str, name: str,
+                   labels: dict = None) -> None:
+        """
+        Wraps a method or classmethod of a class to time every call.
+
+        Nothing is wrapped when metrics are disabled.
+
+        Args:
+            owner (type): The class owning the method.
+            attr (str): The method name.
+            name (str): The histogram name.
+            labels (dict): Extra label values; 'model' is added
+                for classmethods.
+        """
+        if not self.enabled:
+            return
+        original = owner.__dict__[attr]
+        is_classmethod = isinstance(original, classmethod)
+        func = original.__func__ if is_classmethod else original
+        labels = dict(labels or {})
+
+        @wraps(func)
+        def wrapper(first, *args, **kwargs):
+            call_labels = labels
+            if is_classmethod:
+                call_labels = dict(labels, model=first.__name__)
+            with self.timed(name, call_labels):
+                return func(first, *args, **kwargs)
+
+        setattr(owner, attr,
+                classmethod(wrapper) if is_classmethod else wrapper)
+
+    def instrument_view(self, endpoint: str, view: Callable) -> Callable:
+        """
+        Wraps a view function to time its execution.
+
+        Args:
+            endpoint (str): The Flask endpoint name, used as label.
+            view (callable): The view function.
+
+        Returns:
+            callable: The timed view function.
+        """
+        labels = {'endpoint': endpoint}
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with self.timed('api_view_duration_seconds', labels):
+                return view(*args, **kwargs)
+
+        return wrapper
+
+    def count_results(self, owner: type, attr: str, name: str) -> None:
+        """
+        Wraps a lookup method to count hits (result is not None)
+        and misses.
+
+        Args:
+            owner (type): The class owning the method.
+            attr (str): The method name.
+            name (str): The counter name.
+        """
+        if not self.enabled:
+            return
+        func = getattr(owner, attr)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            self.inc(name, {'result': 'miss' if result is None else 'hit'})
+            return result
+
+        setattr(owner, attr, wrapper)
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The exposition text.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                ((key, (h.buckets, list(h.counts), h.count, h.sum))
+                 for key, h in self._histograms.items()),
+                key=lambda item: item[0])
+        lines = []
+        seen = set()
+
+        def header(name: str, default_kind: str) -> None:
+            if name in seen:
+                return
+            seen.add(name)
+            kind, text = self._help.get(name, (default_kind, ''))
+            if text:
+                lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, key), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _format_labels(key), value))
+        for (name, key), (buckets, counts, count, total) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(key, 'le="{}"'.format(bound)),
+                    cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(key, 'le="+Inf"'), count))
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(key), total))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(key), count))
+        for name in sorted(self._gauges):
+            header(name, 'gauge')
+            for labels, value in self._gauges[name]():
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(_label_key(labels)), value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(getenv('API_METRICS', '').lower() in ('1', 'true', 'yes'))
+metrics.describe('api_request_duration_seconds', 'histogram',
+                 'Total request latency, including the auth pipeline.')
+metrics.describe('api_view_duration_seconds', 'histogram',
+                 'View function execution latency.')
+metrics.describe('api_before_request_duration_seconds', 'histogram',
+                 'Latency of the before_request auth pipeline.')
+metrics.describe('api_auth_step_duration_seconds', 'histogram',
+                 'Latency of each step of the auth pipeline.')
+metrics.describe('api_auth_outcomes_total', 'counter',
+                 'Auth pipeline outcomes.')
+metrics.describe('api_session_lookups_total', 'counter',
+                 'Session store lookups by result.')
+metrics.describe('models_operation_duration_seconds', 'histogram',
+                 'Latency of storage operations.')
+metrics.describe('models_store_objects', 'gauge',
+                 'Number of objects held in memory per model.')
+metrics.describe('api_session_store_size', 'gauge',
+                 'Number of sessions held by the session store.')
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Profiler module: opt-in, runtime switchable request profiling.
+
+Requests are profiled one in N or when they carry a trigger header,
+either with cProfile or with a statistical stack sampler. Results are
+aggregated by (route, auth type) and dumped as pstats files or as
+collapsed stacks ready for flamegraph tools.
+"""
+import cProfile
+import os
+import pstats
+import re
+import sys
+import time
+from os import getenv
+from threading import Lock, Thread, get_ident
+from typing import List, Optional, Tuple
+
+
+MODES = ('cprofile', 'sample')
+
+
+def _collapse(frame) -> str:
+    """
+    Builds a root-first, semicolon separated stack from a frame.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                    code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class _Sampler(Thread):
+    """
+    Background thread sampling the stacks of the profiled threads.
+    """
+
+    def __init__(self, profiler: 'Profiler'):
+        super().__init__(name='api-profiler-sampler', daemon=True)
+        self._profiler = profiler
+
+    def run(self) -> None:
+        profiler = self._profiler
+        while True:
+            with profiler._lock:
+                if not profiler._sampled:
+                    profiler._sampler = None
+                    return
+                idents = list(profiler._sampled)
+            frames = sys._current_frames()
+            samples = [(ident, _collapse(frames[ident]))
+                       for ident in idents if ident in frames]
+            del frames
+            with profiler._lock:
+                for ident, stack in samples:
+                    stacks = profiler._sampled.get(ident)
+                    if stacks is not None:
+                        stacks[stack] = stacks.get(stack, 0) + 1
+            time.sleep(profiler.interval)
+
+
+class Profiler:
+    """
+    Per-request profiler, configured from the environment and
+    reconfigurable at runtime with `configure`.
+
+    Environment:
+        PROFILE_EVERY: profile one request in N (0 disables sampling).
+        PROFILE_HEADER: name of a request header triggering profiling.
+        PROFILE_MODE: 'cprofile' (default) or 'sample'.
+        PROFILE_INTERVAL: sampler period in seconds (default 0.005).
+        PROFILE_DIR: directory results are dumped to.
+        PROFILE_CONTROL: set to 1 to allow changing the settings and
+            dumping the results over HTTP (off by default).
+    """
+
+    def __init__(self):
+        """
+        Initializes the profiler from environment variables.
+        """
+        self._lock = Lock()
+        self._counter = 0
+        self._stats = {}
+        self._stacks = {}
+        self._sampled = {}
+        self._sampler = None
+        self.every = 0
+        self.header = None
+        self.mode = 'cprofile'
+        self.interval = 0.005
+        self.directory = 'profiles'
+        self.control = getenv('PROFILE_CONTROL', '').lower() in (
+            '1', 'true', 'yes')
+        self.configure(every=getenv('PROFILE_EVERY', 0),
+                       header=getenv('PROFILE_HEADER'),
+                       mode=getenv('PROFILE_MODE', 'cprofile'),
+                       interval=getenv('PROFILE_INTERVAL', 0.005),
+                       directory=getenv('PROFILE_DIR', 'profiles'))
+
+    @property
+    def active(self) -> bool:
+        """
+        Whether any request may be profiled.
+        """
+        return self.every > 0 or bool(self.header)
+
+    def configure(self, every=None, header=None, mode=None,
+                  interval=None, directory=None) -> dict:
+        """
+        Updates the settings; takes effect on the next request.
+
+        Args:
+            every (int): Profile one request in N, 0 to disable.
+            header (str): Trigger header name, '' to disable.
+            mode (str): 'cprofile' or 'sample'.
+            interval (float): Sampler period in seconds.
+            directory (str): Dump directory.
+
+        Returns:
+            dict: The resulting settings.
+
+        Raises:
+            ValueError: If a setting is invalid; nothing is changed then.
+        """
+        # validate everything before changing anything
+        if mode is not None and mode not in MODES:
+            raise ValueError("mode must be one of {}".format(MODES))
+        try:
+            if every is not None:
+                every = max(int(every), 0)
+        except (TypeError, ValueError):
+            raise ValueError("every must be an integer")
+        try:
+            if interval is not None:
+                interval = max(float(interval), 0.0001)
+        except (TypeError, ValueError):
+            raise ValueError("interval must be a number")
+        if header is not None and not isinstance(header, str):
+            raise ValueError("header must be a string")
+        with self._lock:
+            if every is not None:
+                self.every = every
+            if header is not None:
+                self.header = header or None
+            if mode is not None:
+                self.mode = mode
+            if interval is not None:
+                self.interval = interval
+            if directory is not None:
+                self.directory = directory
+        return self.settings()
+
+    def settings(self) -> dict:
+        """
+        Returns the current settings.
+        """
+        return {'every': self.every, 'header': self.header,
+                'mode': self.mode, 'interval': self.interval,
+                'directory': self.directory, 'control': self.control}
+
+    def start(self, headers) -> Optional[object]:
+        """
+        Starts profiling the current request if it is selected.
+
+        Args:
+            headers: The request headers.
+
+        Returns:
+            A handle to pass to `stop`, or None if not profiled.
+        """
+        selected = bool(self.header) and headers.get(self.header) is not None
+        if not selected and self.every > 0:
+            with self._lock:
+                self._counter += 1
+                selected = self._counter % self.every == 0
+        if not selected:
+            return None
+        if self.mode == 'sample':
+            stacks = {}
+            with self._lock:
+                self._sampled[get_ident()] = stacks
+                if self._sampler is None:
+                    self._sampler = _Sampler(self)
+                    self._sampler.start()
+            return stacks
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already active in this interpreter
+            return None
+        return profile
+
+    def stop(self, handle: object, route: str, auth_type: str) -> None:
+        """
+        Stops profiling and aggregates the results under
+        (route, auth type).
+
+        Args:
+            handle: The value returned by `start`.
+            route (str): The matched URL rule.
+            auth_type (str): The name of the auth class in use.
+        """
+        key = (route, auth_type)
+        if isinstance(handle, cProfile.Profile):
+            handle.disable()
+            with self._lock:
+                stats = self._stats.get(key)
+                if stats is None:
+                    self._stats[key] = pstats.Stats(handle)
+                else:
+                    stats.add(handle)
+            return
+        with self._lock:
+            self._sampled.pop(get_ident(), None)
+            aggregate = self._stacks.setdefault(key, {})
+            for stack, count in handle.items():
+                aggregate[stack] = aggregate.get(stack, 0) + count
+
+    def summary(self) -> List[dict]:
+        """
+        Lists the aggregated profiles.
+
+        Returns:
+            list: One entry per (route, auth type) with its size.
+        """
+        with self._lock:
+            keys = set(self._stats) | set(self._stacks)
+            return [{'route': route, 'auth_type': auth_type,
+                     'calls': (self._stats[(route, auth_type)].total_calls
+                               if (route, auth_type) in self._stats else 0),
+                     'samples': sum(self._stacks.get(
+                         (route, auth_type), {}).values())}
+                    for route, auth_type in sorted(keys)]
+
+    def dump(self, reset: bool = True) -> List[str]:
+        """
+        Writes the aggregated profiles to the dump directory: a .pstats
+        file per key for cProfile results and a .collapsed file per key
+        for sampled stacks.
+
+        Args:
+            reset (bool): Whether to clear the aggregates afterwards.
+
+        Returns:
+            list: The paths written.
+        """
+        with self._lock:
+            stats, stacks = self._stats, self._stacks
+            if reset:
+                self._stats, self._stacks = {}, {}
+            else:
+                stacks = {key: dict(value) for key, value in stacks.items()}
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        for key, value in stats.items():
+            path = os.path.join(self.directory,
+                                self._filename(key) + '.pstats')
+            value.dump_stats(path)
+            paths.append(path)
+        for key, value in stacks.items():
+            if not value:
+                continue
+            path = os.path.join(self.directory,
+                                self._filename(key) + '.collapsed')
+            with open(path, 'w') as f:
+                for stack, count in sorted(value.items()):
+                    f.write('{} {}\n'.format(stack, count))
+            paths.append(path)
+        return paths
+
+    @staticmethod
+    def _filename(key: Tuple[str, str]) -> str:
+        """
+        Builds a file system safe name from a (route, auth type) key.
+        """
+        route, auth_type = key
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', route).strip('_') or 'root'
+        return '{}__{}'.format(name, auth_type)
+
+
+profiler = Profiler()
@@ -2,7 +2,7 @@
 """
 Module providing index views for the API.
 """
-from flask import jsonify, abort
+from flask import jsonify, abort, Response
 from api.v1.views import app_views
 
 
@@ -55,3 +55,20 @@ def handle_forbidden() -> str:
         - Aborts with a 403 status code.
     """
     abort(403)
+
+
+@app_views.route('/metrics', strict_slashes=False)
+def get_metrics() -> str:
+    """
+    GET /api/v1/metrics
+    Expose request latency and auth metrics.
+
+    Returns:
+        - Metrics in the Prometheus text format
+        - 404 error if metrics are disabled (API_METRICS unset)
+    """
+    from api.v1.metrics import metrics
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Module providing views to control the request profiler at runtime.
+"""
+from flask import abort, jsonify, request
+from api.v1.views import app_views
+from api.v1.profiler import profiler
+
+
+@app_views.route('/profiler', methods=['GET'], strict_slashes=False)
+def get_profiler() -> str:
+    """
+    GET /api/v1/profiler
+    Retrieve the profiler settings and the aggregated profiles.
+
+    Returns:
+        - JSON with the settings and one entry per (route, auth type)
+    """
+    return jsonify({"settings": profiler.settings(),
+                    "profiles": profiler.summary()})
+
+
+@app_views.route('/profiler', methods=['PUT'], strict_slashes=False)
+def update_profiler() -> str:
+    """
+    PUT /api/v1/profiler
+    Change the profiler settings without restarting.
+
+    JSON Body:
+        - every (int): profile one request in N, 0 disables (optional)
+        - header (str): trigger header name, "" disables (optional)
+        - mode (str): "cprofile" or "sample" (optional)
+        - interval (float): sampler period in seconds (optional)
+
+    Returns:
+        - JSON with the new settings
+        - 400 error if the body or a setting is invalid
+        - 404 error if runtime control is disabled (PROFILE_CONTROL unset)
+    """
+    if not profiler.control:
+        abort(404)
+    try:
+        settings = apply_settings(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(settings)
+
+
+def apply_settings(body) -> dict:
+    """
+    Applies a PUT /api/v1/profiler body to the profiler.
+    Shared by the Flask views and the ASGI app.
+
+    Args:
+        body: The decoded JSON body.
+
+    Returns:
+        dict: The new settings.
+
+    Raises:
+        ValueError: If the body or a setting is invalid.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Wrong format")
+    return profiler.configure(
+        every=body.get('every'), header=body.get('header'),
+        mode=body.get('mode'), interval=body.get('interval'))
+
+
+@app_views.route('/profiler/dump', methods=['POST'], strict_slashes=False)
+def dump_profiler() -> str:
+    """
+    POST /api/v1/profiler/dump
+    Write the aggregated profiles as .pstats / .collapsed files
+    and reset them.
+
+    Returns:
+        - JSON list of the files written
+        - 404 error if runtime control is disabled (PROFILE_CONTROL unset)
+    """
+    if not profiler.control:
+        abort(404)
+    return jsonify({"files": profiler.dump()})
@@ -3,20 +3,496 @@
 Module providing user-related API views.
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from datetime import datetime
+from flask import abort, jsonify, request, Response
+from itertools import islice
+from models.base import projection
 from models.user import User
+from typing import (Callable, Iterable, Iterator, Mapping, Optional, Tuple,
+                    Union)
+from urllib.parse import urlencode
+import base64
+import json
+import uuid
+import zlib
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+MAX_BATCH_SIZE = 10000
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# per process, so collection versions never collide across restarts
+COLLECTION_ETAG_PREFIX = 'users-' + uuid.uuid4().hex[:8]
+
 
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """
     GET /api/v1/users
-    Retrieve a list of all users.
+    Retrieve a list of all users, or one page of users when `limit`
+    or `cursor` is given.
+
+    Query Parameters:
+        - limit (int): page size, 1 to MAX_PAGE_SIZE (optional)
+        - cursor (str): opaque cursor returned by the previous page
+        - stream (bool): stream every user instead (optional); NDJSON
+          is streamed when `Accept: application/x-ndjson` is preferred
+        - fields (str): comma separated attributes to return (optional)
 
     Returns:
         - JSON list of all User objects
+        - JSON page {"data", "next_cursor", "next"} of User objects,
+          ordered by creation date, when paginating
+        - 304 if If-None-Match matches the collection version
+        - 400 error if limit, cursor or fields is invalid
+    """
+    try:
+        serialize = serializer(requested_fields(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    ndjson = request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+    etag = '{}-{}-{:08x}'.format(
+        COLLECTION_ETAG_PREFIX, User.version(),
+        zlib.crc32(request.query_string + (b'|ndjson' if ndjson else b'')))
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    if ndjson or request.args.get('stream', '').lower() in ('1', 'true'):
+        response = Response(stream_users(ndjson, serialize),
+                            mimetype=NDJSON_MIMETYPE if ndjson
+                            else 'application/json')
+    else:
+        try:
+            response = paginated(list_users(request.args, serialize,
+                                            request.base_url))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    response.set_etag(etag)
+    return response
+
+
+@app_views.route('/users/search', methods=['GET'], strict_slashes=False)
+def search_users() -> str:
+    """
+    GET /api/v1/users/search
+    Find users by email prefix, using the sorted email index.
+
+    Query Parameters:
+        - email_prefix (str): the start of the email addresses (required)
+        - limit (int): page size, 1 to MAX_PAGE_SIZE (optional)
+        - cursor (str): opaque cursor returned by the previous page
+        - fields (str): comma separated attributes to return (optional)
+
+    Returns:
+        - JSON page {"data", "next_cursor", "next"} of User objects,
+          ordered by email
+        - 400 error if email_prefix is missing or a parameter is invalid
+    """
+    try:
+        return paginated(search_page(request.args, request.base_url))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+
+def list_users(args: Mapping, serialize: Callable[[User], dict],
+               base_url: str) -> Union[list, dict]:
+    """
+    Builds the body of GET /api/v1/users when it is not streamed.
+    Shared by the Flask views and the ASGI app.
+
+    Args:
+        args (Mapping): The query parameters.
+        serialize (callable): The user serializer.
+        base_url (str): The URL of the listing, without query string.
+
+    Returns:
+        list: Every user, when neither `limit` nor `cursor` is given.
+        dict: Otherwise the page, see page_body.
+
+    Raises:
+        ValueError: If limit or cursor is invalid.
+    """
+    if 'limit' not in args and 'cursor' not in args:
+        return [serialize(user) for user in User.all()]
+    limit, after = page_args(args, datetime)
+    users, last = User.page(limit, after)
+    return page_body([serialize(user) for user in users], limit, last,
+                     args, base_url)
+
+
+def search_page(args: Mapping, base_url: str) -> dict:
+    """
+    Builds the body of GET /api/v1/users/search.
+    Shared by the Flask views and the ASGI app.
+
+    Args:
+        args (Mapping): The query parameters.
+        base_url (str): The URL of the search, without query string.
+
+    Returns:
+        dict: The page, see page_body.
+
+    Raises:
+        ValueError: If email_prefix is missing or a parameter is invalid.
     """
-    all_user = [user.to_json() for user in User.all()]
-    return jsonify(all_user)
+    prefix = args.get('email_prefix')
+    if prefix is None:
+        raise ValueError("email_prefix missing")
+    serialize = serializer(requested_fields(args))
+    limit, after = page_args(args, str)
+    users, last = User.search_prefix('email', prefix, limit, after)
+    return page_body([serialize(user) for user in users], limit, last,
+                     args, base_url)
+
+
+def page_args(args: Mapping,
+              key_type: type) -> Tuple[int, Optional[tuple]]:
+    """
+    Parses the `limit` and `cursor` query parameters.
+
+    Args:
+        args (Mapping): The query parameters.
+        key_type (type): The type of the keys of the paginated index,
+            datetime for User.page and str for User.search_prefix.
+
+    Returns:
+        tuple: The page size and the index entry to resume after.
+
+    Raises:
+        ValueError: If limit or cursor is invalid.
+    """
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError("limit must be between 1 and {}".format(
+            MAX_PAGE_SIZE))
+    after = None
+    if args.get('cursor'):
+        after = decode_cursor(args.get('cursor'), key_type)
+        if after is None:
+            raise ValueError("invalid cursor")
+    return limit, after
+
+
+def requested_fields(args: Mapping) -> Optional[Tuple[str, ...]]:
+    """
+    Parses the `fields` query parameter.
+
+    Args:
+        args (Mapping): The query parameters.
+
+    Returns:
+        tuple: The requested attribute names, deduplicated in order,
+            or None when every attribute is requested.
+    """
+    raw = args.get('fields')
+    if not raw:
+        return None
+    fields = tuple(dict.fromkeys(
+        field.strip() for field in raw.split(',') if field.strip()))
+    return fields or None
+
+
+def serializer(fields: Optional[Tuple[str, ...]]) -> Callable[[User], dict]:
+    """
+    Returns the function serializing users for the requested fields.
+
+    Args:
+        fields (tuple): The requested attributes, None for all of them.
+
+    Returns:
+        callable: User.to_json or a precompiled projection.
+
+    Raises:
+        ValueError: If a requested field is private.
+    """
+    if fields is None:
+        return User.to_json
+    return projection(fields)
+
+
+def user_etag(user: User, fields: Optional[Tuple[str, ...]] = None) -> str:
+    """
+    Builds the strong ETag of a user from its id and last update,
+    and the requested fields since they change the representation.
+
+    Args:
+        user (User): The user.
+        fields (tuple): The requested attributes, None for all of them.
+
+    Returns:
+        str: The unquoted ETag value.
+    """
+    etag = '{}-{}'.format(user.id, user.updated_at.strftime('%Y%m%d%H%M%S%f'))
+    if fields is not None:
+        etag += '-{:08x}'.format(zlib.crc32(','.join(fields).encode()))
+    return etag
+
+
+def not_modified(etag: str) -> Response:
+    """
+    Builds an empty 304 response carrying the ETag.
+
+    Args:
+        etag (str): The current ETag of the resource.
+
+    Returns:
+        Response: The 304 Not Modified response.
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def stream_users(ndjson: bool = False,
+                 serialize: Callable[[User], dict] = User.to_json
+                 ) -> Iterator[str]:
+    """
+    Yields every user serialized, in creation order, one chunk of
+    STREAM_CHUNK_SIZE users at a time, walking the ordered index so
+    only one chunk is held in memory.
+
+    Args:
+        ndjson (bool): Yield newline delimited JSON instead of one array.
+        serialize (callable): The user serializer.
+
+    Yields:
+        str: The next chunk of the response body.
+    """
+    separator = '\n' if ndjson else ','
+    if not ndjson:
+        yield '['
+    first = True
+    after = None
+    while True:
+        users, after = User.page(STREAM_CHUNK_SIZE, after)
+        if users:
+            chunk = separator.join(json.dumps(serialize(user))
+                                   for user in users)
+            if ndjson:
+                chunk += '\n'
+            elif not first:
+                chunk = ',' + chunk
+            first = False
+            yield chunk
+        if after is None:
+            break
+    if not ndjson:
+        yield ']'
+
+
+def encode_cursor(entry: tuple) -> str:
+    """
+    Encodes an index entry (key, id) as an opaque cursor.
+
+    Args:
+        entry (tuple): The index entry to resume after.
+
+    Returns:
+        str: The URL safe cursor.
+    """
+    key, obj_id = entry
+    if isinstance(key, datetime):
+        key = ['d', key.isoformat()]
+    else:
+        key = ['s', key]
+    raw = json.dumps([key, obj_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, key_type: type = None) -> tuple:
+    """
+    Decodes a cursor built by encode_cursor.
+
+    Index keys are compared with the decoded key, so a key of another
+    type (a cursor of another listing, an aware datetime against the
+    naive created_at) is rejected rather than left to fail in the sort.
+
+    Args:
+        cursor (str): The opaque cursor.
+        key_type (type): The expected key type, datetime or str;
+            None accepts both.
+
+    Returns:
+        tuple: The index entry (key, id), or None if the cursor is invalid.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        (kind, key), obj_id = json.loads(raw)
+        if kind == 'd':
+            key = datetime.fromisoformat(key)
+            if key.tzinfo is not None:
+                return None
+        elif kind != 's' or not isinstance(key, str):
+            return None
+        if key_type is not None and not isinstance(key, key_type):
+            return None
+        return (key, str(obj_id))
+    except (ValueError, TypeError):
+        return None
+
+
+def page_body(data: list, limit: int, last: Optional[tuple],
+              args: Mapping, base_url: str) -> dict:
+    """
+    Builds a page with the cursor and the URL of the next page.
+
+    Args:
+        data (list): The serialized objects of the page.
+        limit (int): The page size.
+        last (tuple): The entry to resume after, None on the last page.
+        args (Mapping): The query parameters of the current page.
+        base_url (str): The URL of the listing, without query string.
+
+    Returns:
+        dict: {"data", "next_cursor", "next"}.
+    """
+    next_cursor = None
+    next_url = None
+    if last is not None:
+        next_cursor = encode_cursor(last)
+        query = {key: args.get(key) for key in args}
+        query.update(limit=limit, cursor=next_cursor)
+        next_url = "{}?{}".format(base_url, urlencode(query))
+    return {"data": data, "next_cursor": next_cursor, "next": next_url}
+
+
+def paginated(body: Union[list, dict]) -> Response:
+    """
+    Builds the JSON response of a listing.
+
+    Args:
+        body: The listing, a page (see page_body) or a plain list.
+
+    Returns:
+        Response: The JSON response, with a `Link: rel="next"` header
+            if there is a next page.
+    """
+    response = jsonify(body)
+    if isinstance(body, dict) and body.get('next') is not None:
+        response.headers['Link'] = '<{}>; rel="next"'.format(body['next'])
+    return response
+
+
+def new_user(body) -> User:
+    """
+    Builds an unsaved user from a POST /api/v1/users body.
+    Shared by the single and batch creation, in both apps.
+
+    Args:
+        body: The decoded JSON body.
+
+    Returns:
+        User: The new user.
+
+    Raises:
+        ValueError: If the body is invalid, with the error message.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Wrong format")
+    if body.get("email", "") == "":
+        raise ValueError("email missing")
+    if body.get("password", "") == "":
+        raise ValueError("password missing")
+    try:
+        user = User()
+        user.email = body.get("email")
+        user.password = body.get("password")
+        user.first_name = body.get("first_name")
+        user.last_name = body.get("last_name")
+    except Exception as e:
+        raise ValueError("Can't create User: {}".format(e))
+    return user
+
+
+def update_fields(user: User, body) -> None:
+    """
+    Applies a PUT /api/v1/users/<user_id> body to a user, unsaved.
+
+    Args:
+        user (User): The user.
+        body: The decoded JSON body.
+
+    Raises:
+        ValueError: If the body is not a JSON object.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Wrong format")
+    if body.get('first_name') is not None:
+        user.first_name = body.get('first_name')
+    if body.get('last_name') is not None:
+        user.last_name = body.get('last_name')
+
+
+def ndjson_items(lines: Iterable[bytes]) -> list:
+    """
+    Reads the non-blank lines of an NDJSON batch, stopping after
+    MAX_BATCH_SIZE + 1 of them: enough to refuse an oversized batch
+    without holding all of it in memory.
+
+    Args:
+        lines (iterable): The lines of the body, e.g. the request stream.
+
+    Returns:
+        list: The non-blank lines, as bytes.
+    """
+    return list(islice((line for line in lines if line.strip()),
+                       MAX_BATCH_SIZE + 1))
+
+
+def create_users(items: list) -> Tuple[dict, int]:
+    """
+    Creates the users of a POST /api/v1/users/batch body and saves
+    them in a single storage write.
+
+    Args:
+        items (list): The user objects, or the NDJSON lines as bytes.
+
+    Returns:
+        tuple: The JSON body and the HTTP status, see create_users_batch.
+    """
+    if not items:
+        return {'error': "empty batch"}, 400
+    if len(items) > MAX_BATCH_SIZE:
+        return {'error': "batch larger than {}".format(MAX_BATCH_SIZE)}, 400
+
+    results = []
+    users = []
+    for index, item in enumerate(items):
+        if isinstance(item, bytes):
+            try:
+                item = json.loads(item)
+            except ValueError:
+                item = None
+        try:
+            user = new_user(item)
+        except ValueError as e:
+            results.append({"index": index, "status": 400, "error": str(e)})
+            continue
+        users.append(user)
+        results.append({"index": index, "status": 201, "user": user})
+
+    if users:
+        try:
+            User.save_many(users)
+        except Exception as e:
+            return {'error': "Can't create Users: {}".format(e)}, 400
+    for result in results:
+        if "user" in result:
+            result["user"] = result["user"].to_json()
+
+    if len(users) == len(results):
+        status = 201
+    elif users:
+        status = 207
+    else:
+        status = 400
+    return {"created": len(users), "failed": len(results) - len(users),
+            "results": results}, status
+
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
 def view_one_user(user_id: str = None) -> str:
@@ -27,8 +503,12 @@ def view_one_user(user_id: str = None) -> str:
     Path Parameter:
         - user_id (str): The ID of the user to retrieve.
 
+    Query Parameter:
+        - fields (str): comma separated attributes to return (optional)
+
     Returns:
         - JSON representation of the User object
+        - 304 if If-None-Match matches the user's ETag
         - 404 error if the User ID does not exist or is 'me' and the current user is not authenticated.
     """
     if user_id is None:
@@ -40,7 +520,17 @@ def view_one_user(user_id: str = None) -> str:
     user = User.get(user_id)
     if user is None:
         abort(404)
-    return jsonify(user.to_json())
+    try:
+        fields = requested_fields(request.args)
+        serialize = serializer(fields)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    etag = user_etag(user, fields)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    response = jsonify(serialize(user))
+    response.set_etag(etag)
+    return response
 
 @app_views.route('/users/<user_id>', methods=['DELETE'], strict_slashes=False)
 def delete_user(user_id: str = None) -> str:
@@ -81,31 +571,47 @@ def create_user() -> str:
         - 400 error if the User cannot be created
     """
     requestJSON_body = None
-    error_msg = None
     try:
         requestJSON_body = request.get_json()
     except Exception as e:
         requestJSON_body = None
-    if requestJSON_body is None:
-        error_msg = "Wrong format"
-    if error_msg is None and requestJSON_body.get("email", "") == "":
-        error_msg = "email missing"
-    if error_msg is None and requestJSON_body.get("password", "") == "":
-        error_msg = "password missing"
+    try:
+        user = new_user(requestJSON_body)
+        user.save()
+        return jsonify(user.to_json()), 201
+    except ValueError as e:
+        error_msg = str(e)
+    except Exception as e:
+        error_msg = "Can't create User: {}".format(e)
+    return jsonify({'error': error_msg}), 400
 
 
-    if error_msg is None:
-        try:
-            user = User()
-            user.email = requestJSON_body.get("email")
-            user.password = requestJSON_body.get("password")
-            user.first_name = requestJSON_body.get("first_name")
-            user.last_name = requestJSON_body.get("last_name")
-            user.save()
-            return jsonify(user.to_json()), 201
-        except Exception as e:
-            error_msg = "Can't create User: {}".format(e)
-    return jsonify({'error': error_msg}), 400
+@app_views.route('/users/batch', methods=['POST'], strict_slashes=False)
+def create_users_batch() -> str:
+    """
+    POST /api/v1/users/batch
+    Create many users at once, persisted in a single storage write.
+
+    Body:
+        - JSON array of user objects (same fields as POST /api/v1/users),
+          or one user object per line with `Content-Type:
+          application/x-ndjson`; at most MAX_BATCH_SIZE users
+
+    Returns:
+        - JSON {"created", "failed", "results"} with one result per item,
+          in order: {"index", "status": 201, "user"} or
+          {"index", "status": 400, "error"}
+        - status 201 if every user was created, 207 on partial
+          failure, 400 if none was created or the body is invalid
+    """
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = ndjson_items(request.stream)
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            return jsonify({'error': "Wrong format"}), 400
+    body, status = create_users(items)
+    return jsonify(body), status
 
 @app_views.route('/users/<user_id>', methods=['PUT'], strict_slashes=False)
 def update_user(user_id: str = None) -> str:
@@ -136,12 +642,10 @@ def update_user(user_id: str = None) -> str:
         requestJSON_body = request.get_json()
     except Exception as e:
         requestJSON_body = None
-    if requestJSON_body is None:
-        return jsonify({'error': "Wrong format"}), 400
-    if requestJSON_body.get('first_name') is not None:
-        user.first_name = requestJSON_body.get('first_name')
-    if requestJSON_body.get('last_name') is not None:
-        user.last_name = requestJSON_body.get('last_name')
+    try:
+        update_fields(user, requestJSON_body)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     user.save()
     return jsonify(user.to_json()), 200
 
@@ -151,10 +655,24 @@ def get_authenticated_user():
     GET /api/v1/users/me
     Retrieve the authenticated user's information.
 
+    Query Parameter:
+        - fields (str): comma separated attributes to return (optional)
+
     Returns:
         - JSON representation of the authenticated User object
+        - 304 if If-None-Match matches the user's ETag
         - 404 error if no user is currently authenticated
     """
     if request.current_user is None:
         abort(404)
-    return jsonify(request.current_user.to_json())
+    try:
+        fields = requested_fields(request.args)
+        serialize = serializer(fields)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    etag = user_etag(request.current_user, fields)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    response = jsonify(serialize(request.current_user))
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Checks that api.v1.asgi answers like the Flask app api.v1.app, then
+compares their in-process throughput on authenticated requests.
+
+Usage: AUTH_TYPE=session_auth SESSION_NAME=_my_session_id \
+       ./bench_asgi.py [requests] [concurrency]
+"""
+import asyncio
+import base64
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+import api.v1.app
+import api.v1.asgi
+from api.v1.app import app as flask_app
+from api.v1.asgi import app as asgi_app
+from api.v1.auth.basic_auth import BasicAuth
+from models.user import User
+
+VOLATILE = ('id', 'created_at', 'updated_at')
+
+
+async def asgi_call(method: str, path: str, headers: dict = None,
+                    body: bytes = b''):
+    """ Calls the ASGI app directly, returns (status, body) """
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query.encode(),
+             'headers': [(k.lower().encode(), v.encode())
+                         for k, v in (headers or {}).items()]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    return (messages[0]['status'],
+            b''.join(m.get('body', b'') for m in messages[1:]))
+
+
+def flask_call(client, method: str, path: str, headers: dict = None,
+               body: bytes = b''):
+    """ Calls the Flask app through its test client """
+    response = client.open(path, method=method, headers=headers or {},
+                           data=body)
+    return response.status_code, response.get_data()
+
+
+def normalize(body: bytes):
+    """ Parses a JSON body, dropping the values that differ per run """
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+
+    def strip(value):
+        if isinstance(value, dict):
+            return {k: strip(v) for k, v in value.items()
+                    if k not in VOLATILE and k not in ('next', 'next_cursor')}
+        if isinstance(value, list):
+            return [strip(v) for v in value]
+        return value
+    return strip(data)
+
+
+def new_user(email: str, password: str) -> str:
+    """ Saves a user and returns its ID """
+    user = User()
+    user.email = email
+    user.password = password
+    user.save()
+    return user.id
+
+
+def login(email: str, password: str) -> dict:
+    """ Opens a session through the Flask app, returns its headers """
+    client = flask_app.test_client()
+    client.post('/api/v1/auth_session/login',
+                data={'email': email, 'password': password})
+    cookie = client.get_cookie(getenv('SESSION_NAME'))
+    return {'Cookie': '{}={}'.format(getenv('SESSION_NAME'),
+                                     cookie.value if cookie else '')}
+
+
+def compare(cases: list) -> bool:
+    """
+    Sends each case to both apps and compares the answers. A path may
+    contain {user}, replaced by a new user for each app, and headers
+    may be a callable, called for each app (e.g. for a new session).
+    """
+    client = flask_app.test_client(use_cookies=False)
+    ok = True
+    for method, path, hdrs, body in cases:
+        answers = []
+        for call in (lambda *a: flask_call(client, *a),
+                     lambda *a: asyncio.run(asgi_call(*a))):
+            target = path
+            if '{user}' in path:
+                target = path.format(
+                    user=new_user('target@example.com', 'pwd'))
+            answers.append(call(method, target,
+                                hdrs() if callable(hdrs) else hdrs, body))
+        expected, got = answers
+        same = expected[0] == got[0] and \
+            normalize(expected[1]) == normalize(got[1])
+        ok = ok and same
+        print('{} {:6} {:45} flask={} asgi={}'.format(
+            'ok  ' if same else 'DIFF', method, path, expected[0], got[0]))
+    return ok
+
+
+def check_equivalence() -> bool:
+    """ Sends the same requests to both apps and compares the answers """
+    for i in range(3):
+        new_user('bench{}@example.com'.format(i), 'pwd{}'.format(i))
+    form = {'Content-Type': 'application/x-www-form-urlencoded'}
+    headers = login('bench0@example.com', 'pwd0')
+    json_headers = dict(headers, **{'Content-Type': 'application/json'})
+    ndjson_headers = dict(headers,
+                          **{'Content-Type': 'application/x-ndjson'})
+    cases = [
+        ('GET', '/api/v1/status', {}, b''),
+        ('GET', '/api/v1/status/', {}, b''),
+        ('GET', '/api/v1/unauthorized', {}, b''),
+        ('GET', '/api/v1/forbidden', {}, b''),
+        ('GET', '/api/v1/users', {}, b''),
+        ('GET', '/api/v1/users', {'Cookie': 'x=y'}, b''),
+        ('GET', '/api/v1/stats', headers, b''),
+        ('GET', '/api/v1/users', headers, b''),
+        ('GET', '/api/v1/users?limit=2', headers, b''),
+        ('GET', '/api/v1/users?limit=0', headers, b''),
+        ('GET', '/api/v1/users?fields=email', headers, b''),
+        ('GET', '/api/v1/users?fields=_password', headers, b''),
+        ('GET', '/api/v1/users?stream=1', headers, b''),
+        ('GET', '/api/v1/users/me', headers, b''),
+        ('GET', '/api/v1/users/nope', headers, b''),
+        ('GET', '/api/v1/users/search?email_prefix=bench1', headers, b''),
+        ('GET', '/api/v1/nowhere', headers, b''),
+        ('POST', '/api/v1/users', json_headers, b'{"email": "new"}'),
+        ('POST', '/api/v1/users', json_headers, b'not json'),
+        ('POST', '/api/v1/auth_session/login', form, b'email=bench1%40ex'),
+        ('POST', '/api/v1/auth_session/login', form,
+         b'email=nobody&password=x'),
+        ('POST', '/api/v1/auth_session/login', form,
+         b'email=bench1%40example.com&password=bad'),
+        ('PUT', '/api/v1/users/{user}', json_headers,
+         b'{"first_name": "Bob", "last_name": "Dylan"}'),
+        ('PUT', '/api/v1/users/{user}', json_headers, b'[]'),
+        ('PUT', '/api/v1/users/nope', json_headers, b'{}'),
+        ('DELETE', '/api/v1/users/{user}', headers, b''),
+        ('DELETE', '/api/v1/users/nope', headers, b''),
+        ('POST', '/api/v1/users/batch', json_headers,
+         b'[{"email": "batch0@example.com", "password": "x"},'
+         b' {"email": "batch1@example.com"}, 3]'),
+        ('POST', '/api/v1/users/batch', ndjson_headers,
+         b'{"email": "batch2@example.com", "password": "x"}\n\nnope\n'),
+        ('POST', '/api/v1/users/batch', json_headers, b'[]'),
+        ('POST', '/api/v1/users/batch', json_headers, b'{}'),
+        ('GET', '/api/v1/users/batch', headers, b''),
+        ('GET', '/api/v1/metrics', {}, b''),
+        ('GET', '/api/v1/profiler', headers, b''),
+        ('PUT', '/api/v1/profiler', json_headers, b'{"mode": "nope"}'),
+        ('PUT', '/api/v1/profiler', json_headers, b'not json'),
+        ('DELETE', '/api/v1/auth_session/logout',
+         lambda: login('bench2@example.com', 'pwd2'), b''),
+        ('DELETE', '/api/v1/auth_session/logout', {'Cookie': 'x=y'}, b''),
+    ]
+    ok = compare(cases)
+
+    # the same pipeline with Basic authentication
+    saved = api.v1.app.auth, api.v1.asgi.auth
+    api.v1.app.auth = api.v1.asgi.auth = BasicAuth()
+    try:
+        def basic(credentials: bytes) -> dict:
+            return {'Authorization': 'Basic '
+                    + base64.b64encode(credentials).decode()}
+        ok = compare([
+            ('GET', '/api/v1/users/me',
+             basic(b'bench1@example.com:pwd1'), b''),
+            ('GET', '/api/v1/users/me',
+             basic(b'bench1@example.com:bad'), b''),
+            ('GET', '/api/v1/users/me', basic(b'no colon'), b''),
+            ('GET', '/api/v1/users/me', {'Authorization': 'Bearer x'}, b''),
+            ('GET', '/api/v1/users', {}, b''),
+            ('GET', '/api/v1/status', {}, b''),
+        ]) and ok
+    finally:
+        api.v1.app.auth, api.v1.asgi.auth = saved
+    return ok
+
+
+def bench(n: int, concurrency: int) -> None:
+    """ Compares the throughput of GET /api/v1/users/me """
+    client = flask_app.test_client()
+    client.post('/api/v1/auth_session/login',
+                data={'email': 'bench0@example.com', 'password': 'pwd0'})
+    session_id = client.get_cookie(getenv('SESSION_NAME')).value
+    headers = {'Cookie': '{}={}'.format(getenv('SESSION_NAME'), session_id)}
+    path = '/api/v1/users/me'
+
+    def flask_one(_):
+        client = flask_app.test_client(use_cookies=False)
+        return client.get(path, headers=headers).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        statuses = list(pool.map(flask_one, range(n)))
+    flask_time = time.perf_counter() - start
+    assert set(statuses) == {200}, statuses[:5]
+
+    async def run_asgi():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                return (await asgi_call('GET', path, headers))[0]
+        return await asyncio.gather(*(one() for _ in range(n)))
+
+    start = time.perf_counter()
+    statuses = asyncio.run(run_asgi())
+    asgi_time = time.perf_counter() - start
+    assert set(statuses) == {200}, statuses[:5]
+
+    print('GET {} x{} (concurrency {}), in-process, no server:'.format(
+        path, n, concurrency))
+    print('  flask (threads): {:8.0f} req/s'.format(n / flask_time))
+    print('  asgi (asyncio):  {:8.0f} req/s'.format(n / asgi_time))
+
+
+if __name__ == "__main__":
+    if getenv('AUTH_TYPE') is None or getenv('SESSION_NAME') is None:
+        sys.exit("set AUTH_TYPE=session_auth and SESSION_NAME")
+    if not check_equivalence():
+        sys.exit("the ASGI app does not answer like the Flask app")
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+          int(sys.argv[2]) if len(sys.argv) > 2 else 32)
@@ -2,20 +2,51 @@
 """ Base module
 """
 from datetime import datetime
-from typing import TypeVar, List, Iterable
+from functools import lru_cache
+from typing import TypeVar, List, Iterable, Optional, Tuple, Callable
 from os import path
+from models.index import SortedIndex
 import json
 import uuid
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+INDEXES = {}
+VERSIONS = {}
+
+
+@lru_cache(maxsize=128)
+def projection(fields: Tuple[str, ...]) -> Callable[['Base'], dict]:
+    """ Return a function serializing only the given public attributes
+    of an object, like to_json() restricted to fields; compiled once
+    per field set
+    """
+    for field in fields:
+        if not field or field[0] == '_':
+            raise ValueError("invalid field: {}".format(field))
+
+    def project(obj: 'Base') -> dict:
+        attrs = obj.__dict__
+        result = {}
+        for field in fields:
+            if field in attrs:
+                value = attrs[field]
+                if type(value) is datetime:
+                    value = value.strftime(TIMESTAMP_FORMAT)
+                result[field] = value
+        return result
+    return project
 
 
 class Base():
     """ Base class
     """
 
+    # attributes kept in a sorted index, with the type of their values,
+    # see page(), search() and search_prefix()
+    INDEXED_ATTRIBUTES = {'created_at': datetime}
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
@@ -64,13 +95,47 @@ class Base():
         s_class = cls.__name__
         file_path = ".db_{}.json".format(s_class)
         DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
+        cls._bump_version()
+        if path.exists(file_path):
+            with open(file_path, 'r') as f:
+                objs_json = json.load(f)
+                for obj_id, obj_json in objs_json.items():
+                    DATA[s_class][obj_id] = cls(**obj_json)
+        cls._rebuild_indexes()
+
+    @classmethod
+    def _bump_version(cls):
+        """ Record that the collection of the class changed
+        """
+        s_class = cls.__name__
+        VERSIONS[s_class] = VERSIONS.get(s_class, 0) + 1
+
+    @classmethod
+    def version(cls) -> int:
+        """ Return a counter incremented on every change of the
+        collection (save, remove, load)
+        """
+        return VERSIONS.get(cls.__name__, 0)
+
+    @classmethod
+    def _indexes(cls) -> dict:
+        """ Return the sorted indexes of the class, by attribute
+        """
+        s_class = cls.__name__
+        if INDEXES.get(s_class) is None:
+            INDEXES[s_class] = {attr: SortedIndex(key_type)
+                                for attr, key_type
+                                in cls.INDEXED_ATTRIBUTES.items()}
+        return INDEXES[s_class]
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def _rebuild_indexes(cls):
+        """ Rebuild all sorted indexes from the stored objects
+        """
+        objs = DATA.get(cls.__name__, {})
+        for attr, index in cls._indexes().items():
+            index.rebuild((obj_id, getattr(obj, attr, None))
+                          for obj_id, obj in objs.items())
 
     @classmethod
     def save_to_file(cls):
@@ -91,14 +156,35 @@ class Base():
         s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
         DATA[s_class][self.id] = self
+        for attr, index in self._indexes().items():
+            index.put(self.id, getattr(self, attr, None))
+        self._bump_version()
         self.__class__.save_to_file()
 
+    @classmethod
+    def save_many(cls, objs: Iterable[TypeVar('Base')]):
+        """ Save many objects with a single write of the file
+        """
+        s_class = cls.__name__
+        now = datetime.utcnow()
+        indexes = cls._indexes()
+        for obj in objs:
+            obj.updated_at = now
+            DATA[s_class][obj.id] = obj
+            for attr, index in indexes.items():
+                index.put(obj.id, getattr(obj, attr, None))
+        cls._bump_version()
+        cls.save_to_file()
+
     def remove(self):
         """ Remove object
         """
         s_class = self.__class__.__name__
         if DATA[s_class].get(self.id) is not None:
             del DATA[s_class][self.id]
+            for index in self._indexes().values():
+                index.discard(self.id)
+            self._bump_version()
             self.__class__.save_to_file()
 
     @classmethod
@@ -121,6 +207,22 @@ class Base():
         s_class = cls.__name__
         return DATA[s_class].get(id)
 
+    @classmethod
+    def page(cls, limit: int, after: Optional[tuple] = None,
+             attribute: str = 'created_at'
+             ) -> Tuple[List[TypeVar('Base')], Optional[tuple]]:
+        """ Return up to limit objects ordered by (attribute, id),
+        starting strictly after the entry after, and the entry to
+        resume from (None on the last page)
+        """
+        s_class = cls.__name__
+        entries = cls._indexes()[attribute].after(after, limit + 1)
+        objs = [DATA[s_class].get(obj_id) for _, obj_id in entries[:limit]]
+        objs = [obj for obj in objs if obj is not None]
+        if len(entries) <= limit:
+            return objs, None
+        return objs, entries[limit - 1]
+
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
@@ -135,4 +237,30 @@ class Base():
                     return False
             return True
 
-        return list(filter(_search, DATA[s_class].values()))
+        objs = DATA[s_class]
+        indexes = cls._indexes()
+        for k, v in attributes.items():
+            index = indexes.get(k)
+            if index is not None and v is not None \
+                    and isinstance(v, index.key_type):
+                candidates = (objs.get(obj_id) for obj_id in index.equal(v))
+                return [obj for obj in candidates
+                        if obj is not None and _search(obj)]
+        return list(filter(_search, objs.values()))
+
+    @classmethod
+    def search_prefix(cls, attribute: str, prefix: str, limit: int,
+                      after: Optional[tuple] = None
+                      ) -> Tuple[List[TypeVar('Base')], Optional[tuple]]:
+        """ Return up to limit objects whose indexed string attribute
+        starts with prefix, ordered by (attribute, id), starting strictly
+        after the entry after, and the entry to resume from (None on the
+        last page)
+        """
+        s_class = cls.__name__
+        entries = cls._indexes()[attribute].prefix(prefix, after, limit + 1)
+        objs = [DATA[s_class].get(obj_id) for _, obj_id in entries[:limit]]
+        objs = [obj for obj in objs if obj is not None]
+        if len(entries) <= limit:
+            return objs, None
+        return objs, entries[limit - 1]
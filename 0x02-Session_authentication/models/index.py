@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+""" Index module
+"""
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Iterable, List, Optional, Tuple
+
+
+class SortedIndex():
+    """ Ordered index of (key, id) entries, kept sorted with bisect
+    """
+
+    def __init__(self, key_type: type = object):
+        """ Initialize an empty index; None and values that are not
+        instances of key_type are not indexed, so keys always compare
+        """
+        self.key_type = key_type
+        self._entries = []
+        self._keys = {}
+
+    def __len__(self) -> int:
+        """ Number of indexed objects
+        """
+        return len(self._entries)
+
+    def put(self, obj_id: str, key: Any):
+        """ Index an object under key, replacing its previous entry
+        """
+        if obj_id in self._keys:
+            if self._keys[obj_id] == key:
+                return
+            self.discard(obj_id)
+        if key is None or not isinstance(key, self.key_type):
+            return
+        self._keys[obj_id] = key
+        insort(self._entries, (key, obj_id))
+
+    def discard(self, obj_id: str):
+        """ Remove the entry of an object, if any
+        """
+        key = self._keys.pop(obj_id, None)
+        if key is None:
+            return
+        i = bisect_left(self._entries, (key, obj_id))
+        if i < len(self._entries) and self._entries[i] == (key, obj_id):
+            del self._entries[i]
+
+    def rebuild(self, items: Iterable[Tuple[str, Any]]):
+        """ Replace the whole index from (id, key) pairs
+        """
+        self._keys = {obj_id: key for obj_id, key in items
+                      if key is not None and isinstance(key, self.key_type)}
+        self._entries = sorted((key, obj_id)
+                               for obj_id, key in self._keys.items())
+
+    def after(self, entry: Optional[Tuple[Any, str]] = None,
+              limit: int = None) -> List[Tuple[Any, str]]:
+        """ Return up to limit entries strictly after entry,
+        from the start if entry is None
+        """
+        start = 0 if entry is None else bisect_right(self._entries,
+                                                     tuple(entry))
+        end = None if limit is None else start + limit
+        return self._entries[start:end]
+
+    def equal(self, key: Any) -> List[str]:
+        """ Return the ids of the objects indexed under key
+        """
+        entries = self._entries
+        ids = []
+        for i in range(bisect_left(entries, (key,)), len(entries)):
+            if entries[i][0] != key:
+                break
+            ids.append(entries[i][1])
+        return ids
+
+    def prefix(self, prefix: str, after: Optional[Tuple[str, str]] = None,
+               limit: int = None) -> List[Tuple[str, str]]:
+        """ Return up to limit entries whose string key starts with
+        prefix, strictly after entry after if given
+        """
+        entries = self._entries
+        start = bisect_left(entries, (prefix,))
+        if after is not None:
+            start = max(start, bisect_right(entries, tuple(after)))
+        found = []
+        for i in range(start, len(entries)):
+            if limit is not None and len(found) == limit:
+                break
+            if not entries[i][0].startswith(prefix):
+                break
+            found.append(entries[i])
+        return found
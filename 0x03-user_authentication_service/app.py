@@ -1,11 +1,29 @@
 #!/usr/bin/env python3
 
 from auth import Auth
+from hashing import HashingBusy
 from flask import Flask, jsonify, request, abort, redirect
 
 AUTH = Auth()
 app = Flask(__name__)
 
+@app.teardown_appcontext
+def teardown_db(exception=None) -> None:
+    """
+    Releases the database session used by the request.
+    """
+    AUTH.teardown()
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error) -> str:
+    """
+    Returns 503 when the password hashing pool is saturated, so that
+    a login storm is shed instead of starving the other endpoints.
+    """
+    response = jsonify({"message": "server busy, retry later"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @app.route('/', methods=['GET'])
 def welcome() -> str:
     """
@@ -33,6 +51,8 @@ def user() -> str:
     try:
         AUTH.register_user(email, password)
         return jsonify({"email": f"{email}", "message": "user created"}), 200
+    except HashingBusy:
+        raise
     except Exception:
         return jsonify({"message": "email already registered"}), 400
 
@@ -72,7 +92,7 @@ def logout() -> str:
     session_id = request.cookies.get('session_id')
     user = AUTH.get_user_from_session_id(session_id)
     if user:
-        AUTH.destroy_session(user.id)
+        AUTH.destroy_session(user.id, session_id)
         return redirect('/')
     else:
         abort(403)
@@ -105,12 +125,11 @@ def get_reset_password_token() -> str:
         token if successful, or aborts with HTTP status 403 if the user is not found.
     """
     email = request.form.get('email')
-    user = AUTH.create_session(email)
-    if not user:
-        abort(403)
-    else:
+    try:
         token = AUTH.get_reset_password_token(email)
-        return jsonify({"email": f"{email}", "reset_token": f"{token}"})
+    except ValueError:
+        abort(403)
+    return jsonify({"email": f"{email}", "reset_token": f"{token}"})
 
 @app.route('/reset_password', methods=['PUT'], strict_slashes=False)
 def update_password() -> str:
@@ -129,6 +148,8 @@ def update_password() -> str:
     try:
         AUTH.update_password(reset_token, new_psw)
         return jsonify({"email": f"{email}", "message": "Password updated"}), 200
+    except HashingBusy:
+        raise
     except Exception:
         abort(403)
 
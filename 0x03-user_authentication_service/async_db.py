@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Async DB module: the asyncio counterpart of the DB class, built on the
+SQLAlchemy asyncio extension and the aiosqlite driver.
+"""
+from datetime import datetime
+from functools import wraps
+from os import getenv
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm.exc import NoResultFound
+from db import VALID_FIELDS
+from instrumentation import SQLInstrumentation
+from sqlite_profile import SQLiteProfile, retry_locked_async
+from user import User
+from user_session import UserSession
+import migrations
+from typing import Optional, Tuple
+
+
+def _counted(method):
+    """
+    Counts the calls of an AsyncDB coroutine in the instance's
+    instrumentation.
+    """
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        self.instrumentation.count(method.__name__)
+        return await method(self, *args, **kwargs)
+    return wrapper
+
+
+class AsyncDB:
+    """
+    AsyncDB class provides coroutines for interacting with the user
+    database without blocking the event loop.
+
+    It works on the same a.db file as DB, which owns the schema: `setup`
+    only applies pending migrations and never drops data. Every call
+    runs in its own AsyncSession, so concurrent tasks share nothing.
+    """
+
+    def __init__(self, sqlite_profile: SQLiteProfile = None) -> None:
+        """
+        Initializes a new AsyncDB instance; no connection is opened
+        until the first call.
+
+        Args:
+            sqlite_profile (SQLiteProfile): The pragmas applied to each
+                connection and the lock retry policy. Defaults to a
+                profile configured from the environment (WAL mode).
+        """
+        self._engine = create_async_engine(
+            "sqlite+aiosqlite:///a.db",
+            echo=getenv('DB_ECHO', '').lower() in ('1', 'true', 'yes'))
+        self.instrumentation = SQLInstrumentation()
+        self.instrumentation.attach(self._engine.sync_engine)
+        self.sqlite_profile = sqlite_profile or SQLiteProfile()
+        self.sqlite_profile.apply(self._engine.sync_engine)
+        self._sessionmaker = async_sessionmaker(self._engine,
+                                                expire_on_commit=False)
+
+    async def setup(self) -> int:
+        """
+        Applies the pending migrations, each in its own transaction.
+
+        Returns:
+            int: The resulting schema version.
+        """
+        async with self._engine.begin() as conn:
+            version = await conn.run_sync(migrations.current_version)
+        for target, _, upgrade in migrations.MIGRATIONS:
+            if target <= version:
+                continue
+            async with self._engine.begin() as conn:
+                await conn.run_sync(upgrade)
+                await conn.run_sync(migrations.stamp, target)
+            version = target
+        return version
+
+    async def dispose(self) -> None:
+        """
+        Closes the connections of the engine.
+        """
+        await self._engine.dispose()
+
+    @_counted
+    @retry_locked_async
+    async def add_user(self, email: str, hashed_password: str) -> User:
+        """
+        Adds a new user to the database.
+
+        Args:
+            email (str): The user's email.
+            hashed_password (str): The user's hashed password.
+
+        Returns:
+            User: The newly created User object.
+        """
+        if not email or not hashed_password:
+            return
+        user = User(email=email, hashed_password=hashed_password)
+        async with self._sessionmaker() as session:
+            session.add(user)
+            await session.commit()
+        return user
+
+    @_counted
+    @retry_locked_async
+    async def find_user_by(self, **kwargs) -> User:
+        """
+        Finds a user in the database based on the provided keyword arguments.
+
+        Args:
+            **kwargs: Arbitrary keyword arguments corresponding to User fields.
+
+        Returns:
+            User: The User object that matches the criteria.
+
+        Raises:
+            InvalidRequestError: If no valid fields are provided.
+            NoResultFound: If no user matches the criteria.
+        """
+        if not kwargs or any(x not in VALID_FIELDS for x in kwargs):
+            raise InvalidRequestError
+        async with self._sessionmaker() as session:
+            users = (await session.execute(
+                select(User).filter_by(**kwargs).limit(2))).scalars().all()
+        if len(users) != 1:
+            raise NoResultFound
+        return users[0]
+
+    @_counted
+    @retry_locked_async
+    async def update_user(self, user_id: int, **kwargs) -> None:
+        """
+        Updates a user's attributes in the database, with a single
+        UPDATE statement.
+
+        Args:
+            user_id (int): The ID of the user to update.
+            **kwargs: Arbitrary keyword arguments representing the fields
+                to update.
+
+        Raises:
+            ValueError: If any of the fields in kwargs are not valid.
+            NoResultFound: If no user has this ID.
+        """
+        if any(k not in VALID_FIELDS for k in kwargs):
+            raise ValueError
+        if not kwargs:
+            await self.find_user_by(id=user_id)
+            return
+        async with self._sessionmaker() as session:
+            result = await session.execute(
+                update(User).where(User.id == user_id).values(**kwargs))
+            if not result.rowcount:
+                await session.rollback()
+                raise NoResultFound
+            await session.commit()
+
+    @_counted
+    @retry_locked_async
+    async def add_session(self, user_id: int, session_id: str,
+                          expires_at: datetime) -> UserSession:
+        """
+        Adds a session of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+            session_id (str): The session ID.
+            expires_at (datetime): When the session expires (UTC).
+
+        Returns:
+            UserSession: The newly created session.
+        """
+        user_session = UserSession(session_id=session_id, user_id=user_id,
+                                   created_at=datetime.utcnow(),
+                                   expires_at=expires_at)
+        async with self._sessionmaker() as session:
+            session.add(user_session)
+            await session.commit()
+        return user_session
+
+    @_counted
+    @retry_locked_async
+    async def find_user_by_session(
+            self, session_id: str,
+            now: datetime = None) -> Tuple[User, datetime]:
+        """
+        Finds the user of an unexpired session, in a single query
+        joining sessions to users.
+
+        Args:
+            session_id (str): The session ID.
+            now (datetime): The current time (UTC), defaults to now.
+
+        Returns:
+            tuple: The User and the expiry time of the session.
+
+        Raises:
+            NoResultFound: If the session does not exist or has expired.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        async with self._sessionmaker() as session:
+            row = (await session.execute(
+                select(User, UserSession.expires_at)
+                .join(UserSession, UserSession.user_id == User.id)
+                .where(UserSession.session_id == session_id,
+                       UserSession.expires_at > now))).first()
+        if row is None:
+            raise NoResultFound
+        return row[0], row[1]
+
+    @_counted
+    @retry_locked_async
+    async def session_exists(self, session_id: str,
+                             now: datetime = None) -> bool:
+        """
+        Async variant of DB.session_exists.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        async with self._sessionmaker() as session:
+            row = (await session.execute(
+                select(UserSession.session_id).where(
+                    UserSession.session_id == session_id,
+                    UserSession.expires_at > now))).first()
+        return row is not None
+
+    @_counted
+    @retry_locked_async
+    async def remove_sessions(self, user_id: int,
+                              session_id: Optional[str] = None) -> int:
+        """
+        Removes one session of a user, or all of them.
+
+        Args:
+            user_id (int): The ID of the user.
+            session_id (str): The session to remove, None for all.
+
+        Returns:
+            int: The number of sessions removed.
+        """
+        statement = delete(UserSession).where(UserSession.user_id == user_id)
+        if session_id is not None:
+            statement = statement.where(UserSession.session_id == session_id)
+        async with self._sessionmaker() as session:
+            removed = (await session.execute(statement)).rowcount
+            await session.commit()
+        return removed
@@ -2,16 +2,25 @@
 """
 Password Hashing and Authentication Module
 """
+import asyncio
+from datetime import datetime, timedelta
+from itertools import count
+from os import getenv
 from db import DB
-import bcrypt
+from async_db import AsyncDB
 from user import User
+from session_cache import SessionCache
+from hashing import CostCalibrator, HashingPool, check_legacy, is_legacy
 from sqlalchemy.orm.exc import NoResultFound
 from uuid import uuid4
-from typing import TypeVar
+from typing import Optional, Tuple, TypeVar
+
+# Picks the bcrypt cost factor for this machine, see hashing.py
+CALIBRATOR = CostCalibrator()
 
 def _hash_password(password: str) -> str:
     """
-    Hashes a password using bcrypt.
+    Hashes a password using bcrypt, at the calibrated cost factor.
 
     Args:
         password (str): The password to hash.
@@ -19,7 +28,21 @@ def _hash_password(password: str) -> str:
     Returns:
         str: The hashed password.
     """
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    return CALIBRATOR.hash(password.encode('utf-8'))
+
+def _detached_copy(user: User) -> User:
+    """
+    Copies a user into a new object bound to no session, safe to share
+    between threads.
+
+    Args:
+        user (User): The user to copy.
+
+    Returns:
+        User: The copy.
+    """
+    return User(**{column.name: getattr(user, column.name)
+                   for column in User.__table__.columns})
 
 def _generate_uuid() -> str:
     """
@@ -38,6 +61,118 @@ class Auth:
         Initializes the Auth instance with a database connection.
         """
         self._db = DB()
+        # Calibrate at startup rather than on the first request
+        CALIBRATOR.calibrate()
+        # bcrypt runs off the request threads, see hashing.HashingPool
+        self._hasher = HashingPool()
+        self._sessions = SessionCache()
+        self.session_duration = int(getenv('SESSION_DURATION', 86400))
+        self.purge_every = int(getenv('SESSION_PURGE_EVERY', 100))
+        self._created = count(1)
+        # Created on first use by the *_async methods
+        self._async_db = None
+
+    def _hash(self, password: str) -> bytes:
+        """
+        Hashes a password in the hashing pool, at the calibrated cost.
+
+        Args:
+            password (str): The password to hash.
+
+        Returns:
+            bytes: The hashed password.
+
+        Raises:
+            HashingBusy: If no hashing worker became available in time.
+        """
+        return self._hasher.hash(password.encode('utf-8'), CALIBRATOR.cost)
+
+    def _verify(self, user: User,
+                password: str) -> Tuple[bool, Optional[bytes]]:
+        """
+        Checks a user's password, as a legacy SHA-256 digest or with
+        bcrypt in the hashing pool, and rehashes it when the stored hash
+        used a lower cost factor than the calibrated one or is legacy.
+        Shared by valid_login and valid_login_async.
+
+        Args:
+            user (User): The user.
+            password (str): The password to check.
+
+        Returns:
+            tuple: Whether the password is valid, and the new hash to
+                store, or None if the stored one is kept.
+
+        Raises:
+            HashingBusy: If no hashing worker became available in time.
+        """
+        if is_legacy(user.hashed_password):
+            valid = check_legacy(password.encode('utf-8'),
+                                 user.hashed_password)
+        else:
+            valid = self._hasher.check(password.encode('utf-8'),
+                                       user.hashed_password)
+        if not valid:
+            return False, None
+        if CALIBRATOR.needs_rehash(user.hashed_password):
+            return True, self._hash(password)
+        return True, None
+
+    def _new_session(self) -> Tuple[str, datetime]:
+        """
+        Generates the ID and the expiry of a new session.
+
+        Returns:
+            tuple: The session ID and its expiry date.
+        """
+        return _generate_uuid(), datetime.utcnow() + timedelta(
+            seconds=self.session_duration)
+
+    def _session_added(self, session_id: str, user: User) -> bool:
+        """
+        Caches the user of a session just stored, and counts it.
+
+        Args:
+            session_id (str): The session ID.
+            user (User): The user of the session.
+
+        Returns:
+            bool: Whether the expired sessions are due for a purge,
+                every SESSION_PURGE_EVERY created sessions.
+        """
+        self._sessions.put(session_id, _detached_copy(user),
+                           min(self._sessions.ttl, self.session_duration))
+        return self.purge_every > 0 \
+            and next(self._created) % self.purge_every == 0
+
+    def _session_found(self, session_id: str, user: User,
+                       expires_at: datetime, now: datetime) -> User:
+        """
+        Caches the user of a session read from the database, never past
+        the session's expiry.
+
+        Returns:
+            User: A detached copy of the user.
+        """
+        user = _detached_copy(user)
+        self._sessions.put(session_id, user, min(
+            self._sessions.ttl, (expires_at - now).total_seconds()))
+        return user
+
+    def _invalidate(self, user_id: int, session_id: str = None) -> None:
+        """
+        Drops a session of the user, or all of them, from the cache.
+        """
+        if session_id is None:
+            self._sessions.invalidate_user(user_id)
+        else:
+            self._sessions.invalidate(session_id)
+
+    def teardown(self) -> None:
+        """
+        Releases the database session of the current thread.
+        """
+        self._db.remove_session()
 
     def register_user(self, email: str, password: str) -> User:
         """
@@ -57,12 +192,14 @@ class Auth:
             self._db.find_user_by(email=email)
             raise ValueError(f"User {email} already exists")
         except NoResultFound:
-            hashed_password = _hash_password(password)
+            hashed_password = self._hash(password)
             return self._db.add_user(email, hashed_password)
 
     def valid_login(self, email: str, password: str) -> bool:
         """
-        Validates user login credentials.
+        Validates user login credentials. On success, a password hashed
+        with a lower cost factor than the calibrated one, or imported as
+        a legacy SHA-256 digest, is rehashed.
 
         Args:
             email (str): The user's email address.
@@ -70,16 +207,36 @@ class Auth:
 
         Returns:
             bool: True if the login is valid, False otherwise.
+
+        Raises:
+            HashingBusy: If no hashing worker became available in time.
         """
         try:
             user = self._db.find_user_by(email=email)
         except NoResultFound:
             return False
-        return bcrypt.checkpw(password.encode('utf-8'), user.hashed_password)
+        valid, hashed_password = self._verify(user, password)
+        if hashed_password is not None:
+            self._db.update_user(user.id, hashed_password=hashed_password)
+            self._sessions.invalidate_user(user.id)
+        return valid
+
+    def hashing_stats(self) -> dict:
+        """
+        Returns the bcrypt cost calibration and its measurements, and
+        the hashing pool counters.
+
+        Returns:
+            dict: The calibrator settings and measured hash times,
+                and the pool settings and counters under 'pool'.
+        """
+        return dict(CALIBRATOR.stats(), pool=self._hasher.stats())
 
     def create_session(self, email: str) -> str:
         """
-        Creates a new session for the user.
+        Creates a new session for the user, next to the sessions it
+        already has on other devices. Expired sessions are purged
+        every SESSION_PURGE_EVERY created sessions.
 
         Args:
             email (str): The user's email address.
@@ -89,42 +246,71 @@ class Auth:
         """
         try:
             user = self._db.find_user_by(email=email)
-            session_id = _generate_uuid()
-            self._db.update_user(user.id, session_id=session_id)
-            return session_id
         except NoResultFound:
             return None
+        session_id, expires_at = self._new_session()
+        self._db.add_session(user.id, session_id, expires_at)
+        if self._session_added(session_id, user):
+            self.purge_expired_sessions()
+        return session_id
 
-    def get_user_from_session_id(self, session_id: str) -> str:
+    def get_user_from_session_id(self, session_id: str) -> User:
         """
-        Retrieves the user's email using the session ID.
+        Retrieves the user of an unexpired session, from the session
+        cache when possible; with several worker processes, cache hits
+        are checked against the sessions table (see SessionCache).
 
         Args:
             session_id (str): The session ID.
 
         Returns:
-            str: The user's email address, or None if not found.
+            User: The user, or None if not found or expired.
         """
         if session_id is None:
             return None
+        user = self._sessions.get(session_id)
+        if user is not None:
+            if not self._sessions.verify \
+                    or self._db.session_exists(session_id):
+                return user
+            # destroyed by another process
+            self._sessions.invalidate(session_id)
+            return None
+        now = datetime.utcnow()
         try:
-            user = self._db.find_user_by(session_id=session_id)
-            return user.email
+            user, expires_at = self._db.find_user_by_session(session_id, now)
         except NoResultFound:
             return None
+        return self._session_found(session_id, user, expires_at, now)
+
+    def session_cache_stats(self) -> dict:
+        """
+        Returns the hit/miss metrics of the session cache.
+
+        Returns:
+            dict: The cache metrics.
+        """
+        return self._sessions.stats()
 
-    def destroy_session(self, user_id: int) -> None:
+    def destroy_session(self, user_id: int, session_id: str = None) -> None:
         """
-        Destroys the user's session.
+        Destroys a session of the user, or all of them.
 
         Args:
             user_id (int): The user's ID.
+            session_id (str): The session to destroy, None for all.
         """
-        try:
-            user = self._db.find_user_by(id=user_id)
-            self._db.update_user(user.id, session_id=None)
-        except NoResultFound:
-            pass
+        self._invalidate(user_id, session_id)
+        self._db.remove_sessions(user_id, session_id)
+
+    def purge_expired_sessions(self) -> int:
+        """
+        Deletes the expired sessions from the database.
+
+        Returns:
+            int: The number of sessions deleted.
+        """
+        return self._db.purge_expired_sessions()
 
     def get_reset_password_token(self, email: str) -> str:
         """
@@ -143,6 +329,7 @@ class Auth:
             user = self._db.find_user_by(email=email)
             reset_token = _generate_uuid()
             self._db.update_user(user.id, reset_token=reset_token)
+            self._sessions.invalidate_user(user.id)
             return reset_token
         except NoResultFound:
             raise ValueError("User not found")
@@ -160,7 +347,113 @@ class Auth:
         """
         try:
             user = self._db.find_user_by(reset_token=reset_token)
-            hashed_password = _hash_password(password)
+            hashed_password = self._hash(password)
             self._db.update_user(user.id, hashed_password=hashed_password, reset_token=None)
+            self._sessions.invalidate_user(user.id)
         except NoResultFound:
             raise ValueError("Invalid reset token")
+
+    @property
+    def _adb(self) -> AsyncDB:
+        """
+        Returns the AsyncDB used by the async variants.
+        """
+        if self._async_db is None:
+            self._async_db = AsyncDB()
+        return self._async_db
+
+    async def close_async(self) -> None:
+        """
+        Closes the connections of the AsyncDB.
+        """
+        if self._async_db is not None:
+            await self._async_db.dispose()
+
+    async def register_user_async(self, email: str, password: str) -> User:
+        """
+        Async variant of register_user.
+
+        Raises:
+            ValueError: If the user already exists.
+        """
+        try:
+            await self._adb.find_user_by(email=email)
+            raise ValueError(f"User {email} already exists")
+        except NoResultFound:
+            hashed_password = await asyncio.to_thread(self._hash, password)
+            return await self._adb.add_user(email, hashed_password)
+
+    async def valid_login_async(self, email: str, password: str) -> bool:
+        """
+        Async variant of valid_login; the password check runs in the
+        hashing pool, off the event loop.
+
+        Raises:
+            HashingBusy: If no hashing worker became available in time.
+        """
+        try:
+            user = await self._adb.find_user_by(email=email)
+        except NoResultFound:
+            return False
+        valid, hashed_password = await asyncio.to_thread(
+            self._verify, user, password)
+        if hashed_password is not None:
+            await self._adb.update_user(user.id,
+                                        hashed_password=hashed_password)
+            self._sessions.invalidate_user(user.id)
+        return valid
+
+    async def create_session_async(self, email: str) -> str:
+        """
+        Async variant of create_session.
+        """
+        try:
+            user = await self._adb.find_user_by(email=email)
+        except NoResultFound:
+            return None
+        session_id, expires_at = self._new_session()
+        await self._adb.add_session(user.id, session_id, expires_at)
+        if self._session_added(session_id, user):
+            await asyncio.to_thread(self._purge_in_thread)
+        return session_id
+
+    async def get_user_from_session_id_async(self, session_id: str) -> User:
+        """
+        Async variant of get_user_from_session_id: cache hits return
+        without awaiting unless they must be verified, misses query the
+        database without blocking the event loop.
+        """
+        if session_id is None:
+            return None
+        user = self._sessions.get(session_id)
+        if user is not None:
+            if not self._sessions.verify \
+                    or await self._adb.session_exists(session_id):
+                return user
+            self._sessions.invalidate(session_id)
+            return None
+        now = datetime.utcnow()
+        try:
+            user, expires_at = await self._adb.find_user_by_session(
+                session_id, now)
+        except NoResultFound:
+            return None
+        return self._session_found(session_id, user, expires_at, now)
+
+    async def destroy_session_async(self, user_id: int,
+                                    session_id: str = None) -> None:
+        """
+        Async variant of destroy_session.
+        """
+        self._invalidate(user_id, session_id)
+        await self._adb.remove_sessions(user_id, session_id)
+
+    def _purge_in_thread(self) -> int:
+        """
+        Purges the expired sessions from a worker thread, releasing
+        the thread's database session afterwards.
+        """
+        try:
+            return self.purge_expired_sessions()
+        finally:
+            self._db.remove_session()
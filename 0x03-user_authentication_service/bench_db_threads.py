@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for the DB class, in two phases reported
+separately for each thread count:
+
+- write: every thread adds users, then looks them up and updates them
+  through its own session, and checks that it always reads back what it
+  wrote. Every cycle writes, so SQLite serializes it and it does not
+  scale with threads.
+- read: every thread looks up users seeded beforehand by email and by
+  session ID, the request path of an authenticated call, and checks it
+  gets the right user.
+
+Usage: ./bench_db_threads.py [operations per thread] [max threads]
+Runs in a temporary directory, so a.db is left untouched.
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from threading import Thread
+from uuid import uuid4
+
+
+def worker(db, name: str, ops: int, errors: list) -> None:
+    """
+    Runs add/find/update cycles and records any inconsistency.
+    """
+    try:
+        for i in range(ops):
+            email = "{}-{}@example.com".format(name, i)
+            user = db.add_user(email, "hashed")
+            session_id = str(uuid4())
+            db.update_user(user.id, session_id=session_id)
+            found = db.find_user_by(session_id=session_id)
+            if found.id != user.id or found.email != email:
+                errors.append("{}: read back user {}".format(email, found))
+        db.remove_session()
+    except Exception as e:
+        errors.append("{}: {!r}".format(name, e))
+
+
+def reader(db, name: str, ops: int, errors: list, seeded: list) -> None:
+    """
+    Runs find_user_by/find_user_by_session lookups over the seeded users
+    and records any inconsistency.
+    """
+    try:
+        now = datetime.utcnow()
+        offset = hash(name)
+        for i in range(ops):
+            user_id, email, session_id = seeded[(offset + i) % len(seeded)]
+            found = db.find_user_by(email=email)
+            user, _ = db.find_user_by_session(session_id, now)
+            if found.id != user_id or user.id != user_id:
+                errors.append("{}: read back users {} and {}".format(
+                    email, found, user))
+        db.remove_session()
+    except Exception as e:
+        errors.append("{}: {!r}".format(name, e))
+
+
+def seed(db, count: int) -> list:
+    """
+    Adds `count` users with one session each for the read phase.
+
+    Returns:
+        list: (user ID, email, session ID) tuples.
+    """
+    expires_at = datetime.utcnow() + timedelta(days=1)
+    seeded = []
+    for i in range(count):
+        email = "reader-{}@example.com".format(i)
+        user = db.add_user(email, "hashed")
+        session_id = str(uuid4())
+        db.add_session(user.id, session_id, expires_at)
+        seeded.append((user.id, email, session_id))
+    db.remove_session()
+    return seeded
+
+
+def run(db, target, threads: int, ops: int, *args) -> float:
+    """
+    Runs `threads` `target` workers concurrently and returns operations
+    per second (each cycle of a worker is one operation per DB call).
+    """
+    errors = []
+    pool = [Thread(target=target,
+                   args=(db, "t{}-{}".format(threads, n), ops, errors)
+                   + args)
+            for n in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        sys.exit("{} errors, first: {}".format(len(errors), errors[0]))
+    calls = 3 if target is worker else 2
+    return threads * ops * calls / elapsed
+
+
+if __name__ == "__main__":
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    max_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp())
+    import logging
+    from db import DB
+    db = DB()
+    db._engine.echo = False
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+    seeded = seed(db, 1000)
+    threads = 1
+    while threads <= max_threads:
+        print("{:2} threads: write {:8.0f} ops/s, read {:8.0f} ops/s,"
+              " consistent".format(threads, run(db, worker, threads, ops),
+                                   run(db, reader, threads, ops, seeded)))
+        threads *= 2
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Mixed read/write concurrency benchmark of the SQLite engine profile:
+reader threads resolve sessions (the /profile lookup) while writer
+threads create sessions and update users (the login path). Runs once
+with the SQLite defaults (rollback journal) and once with the profile
+(WAL), and reports read latency percentiles and throughput.
+
+Usage: ./bench_sqlite.py [seconds] [readers] [writers]
+Runs in temporary directories, so a.db is left untouched.
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from uuid import uuid4
+
+
+def reader(db, session_ids: list, stop: Event, latencies: list,
+           errors: list) -> None:
+    """
+    Resolves random sessions until stopped, recording each latency.
+    """
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            db.find_user_by_session(random.choice(session_ids))
+        except Exception as e:
+            errors.append(repr(e))
+        latencies.append(time.perf_counter() - start)
+    db.remove_session()
+
+
+def writer(db, user_ids: list, stop: Event, counts: list,
+           errors: list) -> None:
+    """
+    Logs random users in and updates them until stopped.
+    """
+    while not stop.is_set():
+        user_id = random.choice(user_ids)
+        try:
+            db.add_session(user_id, str(uuid4()),
+                           datetime.utcnow() + timedelta(hours=1))
+            db.update_user(user_id, reset_token=str(uuid4()))
+            counts.append(2)
+        except Exception as e:
+            errors.append(repr(e))
+    db.remove_session()
+
+
+def run(profile, seconds: float, readers: int, writers: int) -> dict:
+    """
+    Seeds a fresh database and runs the readers and writers.
+
+    Returns:
+        dict: Read and write throughput, read percentiles and errors.
+    """
+    from db import DB
+    os.chdir(tempfile.mkdtemp())
+    db = DB(persistent=False, sqlite_profile=profile)
+    user_ids, session_ids = [], []
+    for i in range(200):
+        user = db.add_user("bench-{}@example.com".format(i), "hashed")
+        session_id = str(uuid4())
+        db.add_session(user.id, session_id,
+                       datetime.utcnow() + timedelta(hours=1))
+        user_ids.append(user.id)
+        session_ids.append(session_id)
+    db.remove_session()
+
+    stop = Event()
+    latencies, counts, errors = [], [], []
+    threads = [Thread(target=reader,
+                      args=(db, session_ids, stop, latencies, errors))
+               for _ in range(readers)]
+    threads += [Thread(target=writer,
+                       args=(db, user_ids, stop, counts, errors))
+                for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+
+    def pct(p: float) -> float:
+        if not latencies:
+            return 0.0
+        return latencies[min(int(p / 100 * len(latencies)),
+                             len(latencies) - 1)] * 1000
+
+    with db._engine.connect() as conn:
+        journal = conn.exec_driver_sql("PRAGMA journal_mode").scalar()
+    return {'reads': len(latencies) / seconds,
+            'writes': sum(counts) / seconds,
+            'p50': pct(50), 'p99': pct(99), 'max': pct(100),
+            'errors': len(errors), 'journal': journal}
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    logging.getLogger("db.slow_query").setLevel(logging.ERROR)
+    from sqlite_profile import SQLiteProfile
+    print("{} readers, {} writers, {:g} s each".format(
+        readers, writers, seconds))
+    for name, profile in (("defaults", SQLiteProfile(enabled=False)),
+                          ("profile", SQLiteProfile(enabled=True))):
+        result = run(profile, seconds, readers, writers)
+        print("{:8} ({journal:6}): {reads:8.0f} reads/s "
+              "p50 {p50:6.2f} ms p99 {p99:7.2f} ms max {max:7.2f} ms, "
+              "{writes:6.0f} writes/s, {errors} errors".format(
+                  name, **result))
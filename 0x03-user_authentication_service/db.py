@@ -2,43 +2,125 @@
 """
 Database module for managing user data with SQLAlchemy.
 """
-from sqlalchemy import create_engine
+from datetime import datetime
+from functools import wraps
+from os import getenv
+from sqlalchemy import bindparam, create_engine, delete, select, update
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.session import Session
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.exc import InvalidRequestError, OperationalError
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.pool import QueuePool
 from user import Base, User
-from typing import TypeVar
+from user_session import UserSession
+from instrumentation import SQLInstrumentation
+from sqlite_profile import SQLiteProfile, retry_locked
+import migrations
+from typing import Any, Dict, Iterable, Optional, Tuple, TypeVar
 
 # List of valid fields in the User model
 VALID_FIELDS = ['id', 'email', 'hashed_password', 'session_id', 'reset_token']
 
+# Engine pool settings read from the environment
+POOL_SETTINGS = {
+    'pool_size': 'DB_POOL_SIZE',
+    'max_overflow': 'DB_MAX_OVERFLOW',
+    'pool_recycle': 'DB_POOL_RECYCLE',
+    'pool_timeout': 'DB_POOL_TIMEOUT',
+}
+
+
+def _engine_options() -> dict:
+    """
+    Builds the engine pool options from the environment.
+
+    Returns:
+        dict: Keyword arguments for create_engine.
+    """
+    options = {}
+    for option, variable in POOL_SETTINGS.items():
+        value = getenv(variable)
+        if value is not None:
+            options[option] = int(value)
+    if options:
+        options['poolclass'] = QueuePool
+    return options
+
+def _counted(method):
+    """
+    Counts the calls of a DB method in the instance's instrumentation.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.instrumentation.count(method.__name__)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
 class DB:
     """
     DB class provides methods for interacting with the user database.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, persistent: bool = None,
+                 sqlite_profile: SQLiteProfile = None) -> None:
         """
         Initializes a new DB instance with a SQLite database.
+
+        The engine pool is configured with DB_POOL_SIZE, DB_MAX_OVERFLOW,
+        DB_POOL_RECYCLE and DB_POOL_TIMEOUT when set. Statements are
+        echoed only if DB_ECHO is set; timings are collected by
+        `instrumentation` instead.
+
+        Args:
+            persistent (bool): Keep the existing data and apply the
+                pending migrations instead of recreating the tables.
+                Defaults to the DB_PERSISTENT environment variable.
+            sqlite_profile (SQLiteProfile): The pragmas applied to each
+                connection and the lock retry policy. Defaults to a
+                profile configured from the environment (WAL mode).
         """
-        self._engine = create_engine("sqlite:///a.db", echo=True)
-        # Drop all tables and recreate them
-        Base.metadata.drop_all(self._engine)
-        Base.metadata.create_all(self._engine)
-        self.__session = None
+        if persistent is None:
+            persistent = getenv('DB_PERSISTENT', '').lower() in (
+                '1', 'true', 'yes')
+        self._engine = create_engine(
+            "sqlite:///a.db",
+            echo=getenv('DB_ECHO', '').lower() in ('1', 'true', 'yes'),
+            connect_args={"check_same_thread": False},
+            **_engine_options())
+        self.instrumentation = SQLInstrumentation()
+        self.instrumentation.attach(self._engine)
+        self.sqlite_profile = sqlite_profile or SQLiteProfile()
+        self.sqlite_profile.apply(self._engine)
+        if persistent:
+            migrations.migrate(self._engine)
+        else:
+            # Drop all tables and recreate them at the latest version
+            Base.metadata.drop_all(self._engine)
+            Base.metadata.create_all(self._engine)
+            with self._engine.begin() as conn:
+                migrations.stamp(conn, migrations.LATEST_VERSION)
+        # One session per thread, so concurrent requests never share one
+        self.__session = scoped_session(
+            sessionmaker(bind=self._engine, expire_on_commit=False))
 
     @property
     def _session(self) -> Session:
         """
-        Creates and returns a memoized SQLAlchemy session.
+        Returns the SQLAlchemy session of the current thread.
+        """
+        return self.__session()
+
+    def remove_session(self) -> None:
+        """
+        Closes the session of the current thread and returns its
+        connection to the pool. Call it at the end of each request.
         """
-        if self.__session is None:
-            DBSession = sessionmaker(bind=self._engine)
-            self.__session = DBSession()
-        return self.__session
+        self.__session.remove()
 
+    @_counted
+    @retry_locked
     def add_user(self, email: str, hashed_password: str) -> User:
         """
         Adds a new user to the database.
@@ -58,6 +140,8 @@ class DB:
         session.commit()
         return user
 
+    @_counted
+    @retry_locked
     def find_user_by(self, **kwargs) -> User:
         """
         Finds a user in the database based on the provided keyword arguments.
@@ -77,9 +161,14 @@ class DB:
         session = self._session
         try:
             return session.query(User).filter_by(**kwargs).one()
+        except OperationalError:
+            # let retry_locked see lock conflicts
+            raise
         except Exception:
             raise NoResultFound
 
+    @_counted
+    @retry_locked
     def update_user(self, user_id: int, **kwargs) -> None:
         """
         Updates a user's attributes in the database.
@@ -90,11 +179,221 @@ class DB:
 
         Raises:
             ValueError: If any of the fields in kwargs are not valid.
+            NoResultFound: If no user has this ID.
         """
+        if any(k not in VALID_FIELDS for k in kwargs):
+            raise ValueError
+        if not kwargs:
+            self.find_user_by(id=user_id)
+            return
         session = self._session
-        user = self.find_user_by(id=user_id)
-        for k, v in kwargs.items():
-            if k not in VALID_FIELDS:
+        # Single UPDATE ... WHERE id = ?, without loading the user first
+        updated = session.query(User).filter(User.id == user_id).update(
+            kwargs, synchronize_session='evaluate')
+        if not updated:
+            session.rollback()
+            raise NoResultFound
+        session.commit()
+
+    @_counted
+    def update_users_bulk(
+            self, updates: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        """
+        Updates many users in one transaction, with one executemany
+        UPDATE per distinct set of updated fields.
+
+        Args:
+            updates: (user_id, changes) pairs, changes mapping
+                fields to their new value.
+
+        Returns:
+            int: The number of users updated; unknown IDs are skipped.
+
+        Raises:
+            ValueError: If any of the fields are not valid; nothing
+                is updated then.
+        """
+        # Grouped once, outside of the retried transaction: updates may
+        # be a generator, which a retry could not read again
+        groups = {}
+        for user_id, changes in updates:
+            if any(k not in VALID_FIELDS for k in changes):
                 raise ValueError
-            setattr(user, k, v)
+            if changes:
+                groups.setdefault(tuple(sorted(changes)), []).append(
+                    dict({'v_' + k: v for k, v in changes.items()},
+                         b_id=user_id))
+        if not groups:
+            return 0
+        return self._update_groups(groups)
+
+    @retry_locked
+    def _update_groups(self, groups: Dict[tuple, list]) -> int:
+        """
+        Runs the UPDATE statements of update_users_bulk in one
+        transaction.
+
+        Args:
+            groups (dict): The executemany parameters per tuple of
+                updated fields.
+
+        Returns:
+            int: The number of users updated.
+        """
+        table = User.__table__
+        session = self._session
+        updated = 0
+        try:
+            for fields, params in groups.items():
+                statement = update(table).where(
+                    table.c.id == bindparam('b_id')).values(
+                        {k: bindparam('v_' + k) for k in fields})
+                updated += session.execute(statement, params).rowcount
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        # The rows changed behind the ORM: reload loaded users on access
+        session.expire_all()
+        return updated
+
+    @_counted
+    @retry_locked
+    def add_session(self, user_id: int, session_id: str,
+                    expires_at: datetime) -> UserSession:
+        """
+        Adds a session of a user.
+
+        Args:
+            user_id (int): The ID of the user.
+            session_id (str): The session ID.
+            expires_at (datetime): When the session expires (UTC).
+
+        Returns:
+            UserSession: The newly created session.
+        """
+        user_session = UserSession(session_id=session_id, user_id=user_id,
+                                   created_at=datetime.utcnow(),
+                                   expires_at=expires_at)
+        session = self._session
+        session.add(user_session)
+        session.commit()
+        return user_session
+
+    @_counted
+    @retry_locked
+    def find_user_by_session(
+            self, session_id: str,
+            now: datetime = None) -> Tuple[User, datetime]:
+        """
+        Finds the user of an unexpired session, in a single query
+        joining sessions to users.
+
+        Args:
+            session_id (str): The session ID.
+            now (datetime): The current time (UTC), defaults to now.
+
+        Returns:
+            tuple: The User and the expiry time of the session.
+
+        Raises:
+            NoResultFound: If the session does not exist or has expired.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        row = self._session.execute(
+            select(User, UserSession.expires_at)
+            .join(UserSession, UserSession.user_id == User.id)
+            .where(UserSession.session_id == session_id,
+                   UserSession.expires_at > now)).first()
+        if row is None:
+            raise NoResultFound
+        return row[0], row[1]
+
+    @_counted
+    @retry_locked
+    def session_exists(self, session_id: str, now: datetime = None) -> bool:
+        """
+        Tells whether a session exists and has not expired, with a
+        primary key lookup that loads no user.
+
+        Args:
+            session_id (str): The session ID.
+            now (datetime): The current time (UTC), defaults to now.
+
+        Returns:
+            bool: True if the session is still valid.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        return self._session.execute(
+            select(UserSession.session_id).where(
+                UserSession.session_id == session_id,
+                UserSession.expires_at > now)).first() is not None
+
+    @_counted
+    @retry_locked
+    def remove_sessions(self, user_id: int,
+                        session_id: Optional[str] = None) -> int:
+        """
+        Removes one session of a user, or all of them.
+
+        Args:
+            user_id (int): The ID of the user.
+            session_id (str): The session to remove, None for all.
+
+        Returns:
+            int: The number of sessions removed.
+        """
+        statement = delete(UserSession).where(UserSession.user_id == user_id)
+        if session_id is not None:
+            statement = statement.where(UserSession.session_id == session_id)
+        session = self._session
+        removed = session.execute(statement).rowcount
+        session.commit()
+        return removed
+
+    @_counted
+    def purge_expired_sessions(self, now: datetime = None,
+                               batch_size: int = 1000) -> int:
+        """
+        Deletes the expired sessions in batches walking the expires_at
+        index, committing after each batch so the table is never
+        locked for long. A batch failing on a locked database is
+        retried alone, the committed ones still count.
+
+        Args:
+            now (datetime): The current time (UTC), defaults to now.
+            batch_size (int): The number of rows deleted per batch.
+
+        Returns:
+            int: The number of sessions deleted.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        expired = select(UserSession.session_id).where(
+            UserSession.expires_at <= now).order_by(
+                UserSession.expires_at).limit(batch_size)
+        statement = delete(UserSession).where(
+            UserSession.session_id.in_(expired.scalar_subquery()))
+        purged = 0
+        while True:
+            deleted = self._purge_batch(statement)
+            purged += deleted
+            if deleted < batch_size:
+                return purged
+
+    @retry_locked
+    def _purge_batch(self, statement) -> int:
+        """
+        Runs and commits one batch of purge_expired_sessions.
+
+        Returns:
+            int: The number of sessions deleted.
+        """
+        session = self._session
+        deleted = session.execute(
+            statement, execution_options={'synchronize_session': False}
+        ).rowcount
         session.commit()
+        return deleted
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Password Hashing Cost Calibration Module
+"""
+import bcrypt
+import hashlib
+import hmac
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from math import floor, log2
+from os import cpu_count, getenv
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from typing import Any, Callable, Union
+
+logger = logging.getLogger(__name__)
+
+def _measure_ms(cost: int, runs: int = 3) -> float:
+    """
+    Measures the time of one bcrypt hash at a cost factor.
+
+    Args:
+        cost (int): The bcrypt cost factor.
+        runs (int): The number of hashes timed; the fastest one counts.
+
+    Returns:
+        float: The hash time in milliseconds.
+    """
+    best = None
+    for _ in range(runs):
+        start = perf_counter()
+        bcrypt.hashpw(b'calibration', bcrypt.gensalt(cost))
+        elapsed = (perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# Marks the SHA-256 hex digests imported from the models.base JSON store
+LEGACY_SHA256_PREFIX = 'sha256$'
+
+
+def legacy_sha256(hexdigest: str) -> str:
+    """
+    Wraps a SHA-256 hex digest of a password (as stored by the
+    Basic/Session authentication projects) for the users table.
+
+    Args:
+        hexdigest (str): The SHA-256 hex digest.
+
+    Returns:
+        str: The value to store as hashed_password.
+    """
+    return LEGACY_SHA256_PREFIX + hexdigest.lower()
+
+
+def is_legacy(hashed_password: Union[bytes, str]) -> bool:
+    """
+    Tells whether a stored hash is a legacy SHA-256 digest.
+    """
+    if isinstance(hashed_password, bytes):
+        return hashed_password.startswith(LEGACY_SHA256_PREFIX.encode())
+    return hashed_password.startswith(LEGACY_SHA256_PREFIX)
+
+
+def check_legacy(password: bytes, hashed_password: Union[bytes, str]) -> bool:
+    """
+    Checks a password against a legacy SHA-256 digest.
+
+    Args:
+        password (bytes): The password.
+        hashed_password: The stored legacy digest.
+
+    Returns:
+        bool: True if the password matches.
+    """
+    if isinstance(hashed_password, bytes):
+        hashed_password = hashed_password.decode('utf-8', 'replace')
+    expected = legacy_sha256(hashlib.sha256(password).hexdigest())
+    return hmac.compare_digest(expected, hashed_password)
+
+
+def hash_cost(hashed_password: Union[bytes, str]) -> int:
+    """
+    Reads the cost factor of a bcrypt hash ($2b$<cost>$...).
+
+    Args:
+        hashed_password: The bcrypt hash.
+
+    Returns:
+        int: The cost factor, or None if it is not a bcrypt hash.
+    """
+    if isinstance(hashed_password, bytes):
+        hashed_password = hashed_password.decode('utf-8', 'replace')
+    parts = hashed_password.split('$')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+class CostCalibrator:
+    """
+    Picks the bcrypt cost factor meeting a per-hash latency budget on
+    the current machine, never going below a minimum cost. When even
+    the minimum cost is over the budget, the minimum wins: a warning is
+    logged and stats() reports budget_met False.
+
+    Environment:
+        BCRYPT_TARGET_MS: the per-hash budget in ms (default 100).
+        BCRYPT_MIN_COST: the lowest cost allowed (default 12, the cost
+            bcrypt.gensalt() used before calibration).
+        BCRYPT_MAX_COST: the highest cost allowed (default 16).
+        BCRYPT_COST: a fixed cost, which skips the calibration.
+    """
+
+    def __init__(self, target_ms: float = None, min_cost: int = None,
+                 max_cost: int = None, cost: int = None) -> None:
+        """
+        Initializes the calibrator; settings left to None are read from
+        the environment.
+        """
+        if cost is None and getenv('BCRYPT_COST'):
+            cost = int(getenv('BCRYPT_COST'))
+        self.target_ms = float(target_ms if target_ms is not None
+                               else getenv('BCRYPT_TARGET_MS', 100))
+        self.min_cost = int(min_cost if min_cost is not None
+                            else getenv('BCRYPT_MIN_COST', 12))
+        self.max_cost = int(max_cost if max_cost is not None
+                            else getenv('BCRYPT_MAX_COST', 16))
+        self._cost = cost
+        self._fixed = cost is not None
+        self._lock = Lock()
+        self.measurements = {}
+        self.budget_met = None
+
+    def calibrate(self) -> int:
+        """
+        Times a hash at the minimum cost, extrapolates (each cost step
+        doubles the work) to the highest cost within the budget, then
+        times that cost to confirm it.
+
+        Returns:
+            int: The chosen cost factor.
+        """
+        if self._fixed:
+            return self._cost
+        with self._lock:
+            base = _measure_ms(self.min_cost)
+            measurements = {self.min_cost: base}
+            steps = floor(log2(self.target_ms / base)) if base > 0 else 0
+            cost = min(max(self.min_cost + steps, self.min_cost),
+                       self.max_cost)
+            while cost > self.min_cost:
+                measurements[cost] = _measure_ms(cost, runs=1)
+                if measurements[cost] <= self.target_ms:
+                    break
+                cost -= 1
+            self.measurements = measurements
+            self._cost = cost
+            self.budget_met = measurements[cost] <= self.target_ms
+        if not self.budget_met:
+            logger.warning(
+                "bcrypt cost %d, the minimum, takes %.0f ms: over the "
+                "%.0f ms budget", cost, measurements[cost], self.target_ms)
+        return cost
+
+    @property
+    def cost(self) -> int:
+        """
+        The cost factor in use, calibrating on first use.
+        """
+        if self._cost is None:
+            self.calibrate()
+        return self._cost
+
+    def hash(self, password: bytes) -> bytes:
+        """
+        Hashes a password at the calibrated cost.
+
+        Args:
+            password (bytes): The password.
+
+        Returns:
+            bytes: The bcrypt hash.
+        """
+        return bcrypt.hashpw(password, bcrypt.gensalt(self.cost))
+
+    def needs_rehash(self, hashed_password: Union[bytes, str]) -> bool:
+        """
+        Tells whether a hash was made with a lower cost than the
+        current one. Stronger hashes are kept: rehashing them would
+        lower their work factor.
+
+        Args:
+            hashed_password: The stored hash.
+
+        Returns:
+            bool: True if the password should be hashed again.
+        """
+        cost = hash_cost(hashed_password)
+        return cost is None or cost < self.cost
+
+    def stats(self) -> dict:
+        """
+        Returns the settings and the measurements of the calibration.
+
+        Returns:
+            dict: The cost in use, the budget, whether the cost meets it
+                (None for a fixed cost) and the measured hash times in ms
+                per cost factor.
+        """
+        return {'cost': self.cost, 'fixed': self._fixed,
+                'target_ms': self.target_ms, 'budget_met': self.budget_met,
+                'min_cost': self.min_cost,
+                'max_cost': self.max_cost,
+                'measurements_ms': dict(self.measurements)}
+
+
+class HashingBusy(Exception):
+    """
+    Raised when a hashing task waited too long for a worker.
+    """
+
+
+class HashingPool:
+    """
+    Dedicated pool of threads running the bcrypt work (bcrypt releases
+    the GIL while hashing), so that a burst of logins cannot occupy
+    every request thread. The pool admits at most `workers +
+    queue_size` tasks; a task that cannot be admitted, or that waits
+    in the queue longer than `queue_timeout`, raises HashingBusy.
+
+    Environment:
+        HASH_WORKERS: the number of hashing threads (default: CPUs).
+        HASH_QUEUE_SIZE: the tasks allowed to wait (default 2 per worker).
+        HASH_QUEUE_TIMEOUT: the longest queue wait in seconds (default 1).
+    """
+
+    def __init__(self, workers: int = None, queue_size: int = None,
+                 queue_timeout: float = None) -> None:
+        """
+        Initializes the pool; settings left to None are read from the
+        environment.
+        """
+        self.workers = int(workers if workers is not None
+                           else getenv('HASH_WORKERS', cpu_count() or 1))
+        self.queue_size = int(queue_size if queue_size is not None
+                              else getenv('HASH_QUEUE_SIZE',
+                                          2 * self.workers))
+        self.queue_timeout = float(queue_timeout if queue_timeout is not None
+                                   else getenv('HASH_QUEUE_TIMEOUT', 1))
+        self._executor = ThreadPoolExecutor(self.workers,
+                                            thread_name_prefix='hashing')
+        self._slots = BoundedSemaphore(self.workers + self.queue_size)
+        self._lock = Lock()
+        self.completed = 0
+        self.rejected = 0
+
+    def run(self, func: Callable, *args) -> Any:
+        """
+        Runs a function in the pool and waits for its result.
+
+        Args:
+            func (callable): The function, typically bcrypt work.
+            *args: Its arguments.
+
+        Returns:
+            The result of the function.
+
+        Raises:
+            HashingBusy: If the task was not started within the
+                queue timeout.
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._reject()
+        try:
+            future = self._executor.submit(func, *args)
+            try:
+                result = future.result(timeout=self.queue_timeout)
+            except FutureTimeout:
+                if future.cancel():
+                    # still queued: give up on it
+                    self._reject()
+                # already running: let it finish
+                result = future.result()
+        finally:
+            self._slots.release()
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def hash(self, password: bytes, cost: int) -> bytes:
+        """
+        Hashes a password in the pool.
+        """
+        return self.run(bcrypt.hashpw, password, bcrypt.gensalt(cost))
+
+    def check(self, password: bytes, hashed_password: bytes) -> bool:
+        """
+        Checks a password against its hash in the pool.
+        """
+        return self.run(bcrypt.checkpw, password, hashed_password)
+
+    def stats(self) -> dict:
+        """
+        Returns the pool settings and counters.
+        """
+        with self._lock:
+            return {'workers': self.workers, 'queue_size': self.queue_size,
+                    'queue_timeout': self.queue_timeout,
+                    'completed': self.completed, 'rejected': self.rejected}
+
+    def _reject(self) -> None:
+        """
+        Counts a rejected task and raises HashingBusy.
+        """
+        with self._lock:
+            self.rejected += 1
+        raise HashingBusy("no hashing worker available")
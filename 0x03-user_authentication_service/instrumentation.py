@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+SQL instrumentation for the DB class: per-statement latency histograms,
+a sampled slow-query log and call counters.
+"""
+import logging
+import random
+import re
+from os import getenv
+from threading import Lock
+from time import perf_counter
+from typing import Dict
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the latency buckets, in milliseconds
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+slow_query_logger = logging.getLogger("db.slow_query")
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.I)
+
+
+def normalize(statement: str) -> str:
+    """
+    Normalizes a SQL statement so that executions differing only in
+    literals or whitespace share a key.
+
+    Args:
+        statement (str): The SQL statement.
+
+    Returns:
+        str: The normalized statement.
+    """
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    statement = _LITERALS.sub('?', statement)
+    return _IN_LISTS.sub('IN (?)', statement)
+
+
+class Histogram:
+    """
+    Latency histogram, in milliseconds.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        """
+        Records one latency.
+        """
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self) -> dict:
+        """
+        Returns the histogram as a dictionary.
+        """
+        buckets = {str(bound): n for bound, n in zip(BUCKETS_MS, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+        return {'count': self.count, 'total_ms': self.total_ms,
+                'mean_ms': self.total_ms / self.count if self.count else 0.0,
+                'max_ms': self.max_ms, 'buckets': buckets}
+
+
+class SQLInstrumentation:
+    """
+    Collects SQL timings from engine events.
+
+    The listeners stay attached; when disabled they return right away,
+    so instrumentation can be toggled at runtime with `enabled`.
+
+    Environment:
+        DB_INSTRUMENT: set to 0 to start disabled.
+        DB_SLOW_QUERY_MS: slow-query threshold (default 100).
+        DB_SLOW_QUERY_SAMPLE: fraction of slow queries logged (default 1).
+    """
+
+    def __init__(self):
+        """
+        Initializes the instrumentation from environment variables.
+        """
+        self.enabled = getenv('DB_INSTRUMENT', '1').lower() not in (
+            '0', 'false')
+        self.slow_query_ms = float(getenv('DB_SLOW_QUERY_MS', 100))
+        self.slow_query_sample = float(getenv('DB_SLOW_QUERY_SAMPLE', 1))
+        self._lock = Lock()
+        self._statements = {}
+        self._counters = {}
+
+    def attach(self, engine: Engine) -> None:
+        """
+        Listens to the statement execution events of an engine.
+
+        Args:
+            engine (Engine): The engine to instrument.
+        """
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        event.listen(engine, 'handle_error', self._error)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany) -> None:
+        if self.enabled:
+            conn.info.setdefault('query_start', []).append(perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany) -> None:
+        starts = conn.info.get('query_start')
+        if not starts:
+            return
+        ms = (perf_counter() - starts.pop()) * 1000
+        key = normalize(statement)
+        with self._lock:
+            histogram = self._statements.get(key)
+            if histogram is None:
+                histogram = self._statements[key] = Histogram()
+            histogram.observe(ms)
+        if ms >= self.slow_query_ms \
+                and random.random() < self.slow_query_sample:
+            # parameters are left out, they may hold credentials
+            slow_query_logger.warning("slow query (%.1f ms%s): %s", ms,
+                                      ", executemany" if executemany else "",
+                                      key)
+
+    def _error(self, context) -> None:
+        # a failed statement gets no after_cursor_execute: drop its
+        # start so the stack does not grow on the connection
+        if context.connection is None or context.execution_context is None:
+            return
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+    def count(self, name: str) -> None:
+        """
+        Increments a call counter.
+
+        Args:
+            name (str): The counter name, e.g. a DB method name.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Returns the collected data.
+
+        Returns:
+            dict: {'statements': {statement: histogram}, 'counters': {...}}
+        """
+        with self._lock:
+            return {'statements': {key: h.to_dict()
+                                   for key, h in self._statements.items()},
+                    'counters': dict(self._counters)}
+
+    def reset(self) -> None:
+        """
+        Clears the collected data.
+        """
+        with self._lock:
+            self._statements = {}
+            self._counters = {}
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Load generator for app.py: concurrent virtual users each run the
+register -> login -> profile -> reset_password -> logout flow in a loop,
+and the latency of every request is recorded per endpoint.
+
+The app is driven in-process through the Flask test client (default, in
+a temporary directory so a.db is left untouched) or over HTTP with
+--url. The report gives per-endpoint throughput and p50/p95/p99; --json
+saves it with the run settings, and --baseline compares the run with a
+saved one and exits with status 1 if an endpoint regressed by more than
+--threshold.
+
+Usage: ./loadtest.py [-h] [--url URL] [--users N] [--duration SECONDS]
+                     [--profile-reads N] [--json FILE] [--baseline FILE]
+                     [--threshold PCT]
+
+bcrypt dominates the flow; set BCRYPT_COST (e.g. 4) to load the rest of
+the stack, and use the same settings for runs that are compared.
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+from http.cookies import SimpleCookie
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+from uuid import uuid4
+
+# Compared between runs, in this order
+PERCENTILES = (50, 95, 99)
+
+
+class TestClientTransport:
+    """
+    Sends requests to the app in-process, through the Flask test client.
+    """
+
+    def __init__(self, app) -> None:
+        self._client = app.test_client(use_cookies=False)
+
+    def request(self, method: str, path: str, form: Optional[dict],
+                headers: dict) -> Tuple[int, Optional[str], bytes]:
+        """
+        Sends a request and returns its status, Set-Cookie header
+        and body.
+        """
+        response = self._client.open(path, method=method, data=form,
+                                     headers=headers)
+        body = response.get_data()
+        response.close()
+        return (response.status_code, response.headers.get('Set-Cookie'),
+                body)
+
+
+class HTTPTransport:
+    """
+    Sends requests to a running app over HTTP, reusing the connection
+    when the server keeps it alive.
+    """
+
+    def __init__(self, url: str) -> None:
+        parts = urlsplit(url)
+        self._connection = http.client.HTTPConnection(
+            parts.hostname, parts.port or 80, timeout=30)
+
+    def request(self, method: str, path: str, form: Optional[dict],
+                headers: dict) -> Tuple[int, Optional[str], bytes]:
+        """
+        Sends a request and returns its status, Set-Cookie header
+        and body.
+        """
+        body = None
+        headers = dict(headers)
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self._connection.request(method, path, body, headers)
+            response = self._connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self._connection.close()
+            raise
+        return response.status, response.getheader('Set-Cookie'), data
+
+
+class Recorder:
+    """
+    Collects the latency and outcome of every request, per endpoint.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint: str, seconds: float, ok: bool) -> None:
+        """
+        Records one request.
+        """
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+class VirtualUser(Thread):
+    """
+    Runs the account flow in a loop until stopped.
+    """
+
+    def __init__(self, transport, recorder: Recorder, stop: Event,
+                 profile_reads: int) -> None:
+        super().__init__(daemon=True)
+        self._transport = transport
+        self._recorder = recorder
+        self._stopped = stop
+        self._profile_reads = profile_reads
+        self._cookie = None
+
+    def _call(self, method: str, path: str, form: dict = None,
+              expected: int = 200) -> bytes:
+        """
+        Sends a request, records it and keeps the session cookie.
+
+        Returns:
+            bytes: The response body, empty if the request failed.
+        """
+        headers = {}
+        if self._cookie:
+            headers['Cookie'] = 'session_id=' + self._cookie
+        endpoint = '{} {}'.format(method, path)
+        start = time.perf_counter()
+        try:
+            status, set_cookie, body = self._transport.request(
+                method, path, form, headers)
+        except (http.client.HTTPException, OSError):
+            status, set_cookie, body = None, None, b''
+        self._recorder.record(endpoint, time.perf_counter() - start,
+                              status == expected)
+        if set_cookie:
+            morsel = SimpleCookie(set_cookie).get('session_id')
+            if morsel is not None:
+                self._cookie = morsel.value
+        return body
+
+    def flow(self) -> None:
+        """
+        Runs one register -> login -> profile -> reset_password ->
+        logout flow with a new account.
+        """
+        email = 'load-{}@example.com'.format(uuid4().hex)
+        self._cookie = None
+        self._call('POST', '/users', {'email': email, 'password': 'pwd'})
+        self._call('POST', '/sessions', {'email': email, 'password': 'pwd'})
+        for _ in range(self._profile_reads):
+            self._call('GET', '/profile')
+        body = self._call('POST', '/reset_password', {'email': email})
+        try:
+            token = json.loads(body)['reset_token']
+        except (ValueError, KeyError, TypeError):
+            token = 'missing'
+        self._call('PUT', '/reset_password', {'email': email,
+                                              'reset_token': token,
+                                              'new_password': 'new'})
+        self._call('DELETE', '/sessions', expected=302)
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            self.flow()
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    Returns the nearest-rank percentile of sorted values.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> Dict[str, dict]:
+    """
+    Builds the per-endpoint report, plus an 'ALL' entry.
+
+    Returns:
+        dict: count, errors, throughput (req/s) and percentiles (ms)
+            per endpoint.
+    """
+    report = {}
+    everything = []
+    for endpoint, values in sorted(recorder.latencies.items()):
+        everything.extend(values)
+        report[endpoint] = _stats(values, recorder.errors.get(endpoint, 0),
+                                  elapsed)
+    report['ALL'] = _stats(everything, sum(recorder.errors.values()),
+                           elapsed)
+    return report
+
+
+def _stats(values: List[float], errors: int, elapsed: float) -> dict:
+    """
+    Computes the statistics of one endpoint.
+    """
+    values = sorted(values)
+    stats = {'count': len(values), 'errors': errors,
+             'throughput': len(values) / elapsed if elapsed else 0.0}
+    for pct in PERCENTILES:
+        stats['p{}_ms'.format(pct)] = percentile(values, pct) * 1000
+    return stats
+
+
+def print_report(report: Dict[str, dict]) -> None:
+    """
+    Prints the report as a table.
+    """
+    columns = ['p{}_ms'.format(pct) for pct in PERCENTILES]
+    print('{:24} {:>7} {:>6} {:>9} '.format(
+        'endpoint', 'count', 'errors', 'req/s')
+        + ' '.join('{:>9}'.format(c) for c in columns))
+    for endpoint, stats in report.items():
+        print('{:24} {:7} {:6} {:9.1f} '.format(
+            endpoint, stats['count'], stats['errors'], stats['throughput'])
+            + ' '.join('{:9.2f}'.format(stats[c]) for c in columns))
+
+
+def compare(report: Dict[str, dict], baseline: Dict[str, dict],
+            threshold: float) -> List[str]:
+    """
+    Compares a report with a baseline report.
+
+    Args:
+        report (dict): The endpoints of this run.
+        baseline (dict): The endpoints of the baseline run.
+        threshold (float): The tolerated degradation, in percent.
+
+    Returns:
+        list: A description of every regression.
+    """
+    regressions = []
+    for endpoint, stats in report.items():
+        base = baseline.get(endpoint)
+        if base is None:
+            continue
+        for pct in PERCENTILES:
+            key = 'p{}_ms'.format(pct)
+            if base[key] and stats[key] > base[key] * (1 + threshold / 100):
+                regressions.append('{} {}: {:.2f} ms vs {:.2f} ms'.format(
+                    endpoint, key, stats[key], base[key]))
+        if base['throughput'] and stats['throughput'] \
+                < base['throughput'] * (1 - threshold / 100):
+            regressions.append('{} throughput: {:.1f} vs {:.1f} req/s'.format(
+                endpoint, stats['throughput'], base['throughput']))
+    return regressions
+
+
+def run(make_transport, users: int, duration: float,
+        profile_reads: int) -> Tuple[Recorder, float]:
+    """
+    Runs the virtual users for a duration.
+
+    Returns:
+        tuple: The recorder and the elapsed time in seconds.
+    """
+    recorder = Recorder()
+    stop = Event()
+    threads = [VirtualUser(make_transport(), recorder, stop, profile_reads)
+               for _ in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test app.py.")
+    parser.add_argument('--url', help="base URL of a running app "
+                        "(default: in-process test client)")
+    parser.add_argument('--users', type=int, default=8,
+                        help="concurrent virtual users (default: 8)")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds to run (default: 10)")
+    parser.add_argument('--profile-reads', type=int, default=5,
+                        help="GET /profile per flow (default: 5)")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare with this results file")
+    parser.add_argument('--threshold', type=float, default=10,
+                        help="tolerated regression in percent (default: 10)")
+    args = parser.parse_args()
+
+    if args.url:
+        def make_transport():
+            return HTTPTransport(args.url)
+    else:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.chdir(tempfile.mkdtemp())
+        from app import app
+        # contention makes slow query logs noise here
+        logging.getLogger('db.slow_query').setLevel(logging.ERROR)
+
+        def make_transport():
+            return TestClientTransport(app)
+
+    recorder, elapsed = run(make_transport, args.users, args.duration,
+                            args.profile_reads)
+    report = summarize(recorder, elapsed)
+    print_report(report)
+
+    settings = {'target': args.url or 'in-process', 'users': args.users,
+                'duration': args.duration,
+                'profile_reads': args.profile_reads,
+                'bcrypt_cost': os.getenv('BCRYPT_COST'),
+                'python': platform.python_version(),
+                'cpus': os.cpu_count()}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': settings, 'endpoints': report}, f,
+                      indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changed = [k for k, v in settings.items()
+                   if baseline['settings'].get(k) != v]
+        if changed:
+            print("warning: settings differ from the baseline: "
+                  + ", ".join(changed))
+        regressions = compare(report, baseline['endpoints'], args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("no regression beyond {}%".format(args.threshold))
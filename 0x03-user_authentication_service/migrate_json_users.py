@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Migrates the users of a models.base JSON store (.db_User.json, written
+by the Basic/Session authentication projects) into the users table.
+
+The file is parsed incrementally, one record at a time, and inserted
+with executemany in batches, so memory use does not depend on the file
+size. After each committed batch the byte offset reached is written to
+a checkpoint file; a later run resumes from there. Rows are inserted
+with INSERT OR IGNORE on the unique email, so replaying a batch after
+a crash is harmless.
+
+Field mapping: email -> email, _password (SHA-256 hex digest) ->
+hashed_password as a legacy digest, rehashed with bcrypt by
+Auth.valid_login on the user's next login. Records without an email or
+a password are skipped; the other fields have no column.
+
+The app's default DB() drops and recreates every table at startup,
+wiping the migrated users: run it with DB_PERSISTENT=1 to keep them.
+
+Usage: ./migrate_json_users.py [-h] [--db URL] [--batch-size N]
+                               [--checkpoint FILE] [--restart] [json_file]
+"""
+import argparse
+import codecs
+import json
+import os
+import sys
+from typing import Iterator, Optional, Tuple
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from hashing import legacy_sha256
+from user import User
+import migrations
+
+READ_SIZE = 1 << 16
+WHITESPACE = ' \t\n\r'
+# literals a read may end in the middle of
+LITERALS = ('true', 'false', 'null', 'NaN', 'Infinity', '-Infinity')
+# the fraction or exponent of a number cut by the end of a read
+NUMBER_TAIL = '0123456789.eE+-'
+
+
+def is_truncated(error: json.JSONDecodeError) -> bool:
+    """
+    Tells whether a decode error may be due to the end of the buffer,
+    the value continuing in the next read, rather than to invalid JSON.
+
+    Args:
+        error (JSONDecodeError): The error of raw_decode on the buffer.
+
+    Returns:
+        bool: True if more data could make the value valid.
+    """
+    rest = error.doc[error.pos:]
+    if error.msg.startswith('Unterminated string'):
+        return True
+    if error.msg.startswith('Invalid \\uXXXX escape'):
+        return len(rest) < 6
+    if not rest.strip(NUMBER_TAIL):
+        return True
+    return any(literal.startswith(rest) for literal in LITERALS)
+
+
+def iter_records(path: str, offset: int = 0,
+                 read_size: int = READ_SIZE) -> Iterator[Tuple[dict, int]]:
+    """
+    Streams the records of a JSON object mapping IDs to records.
+
+    Args:
+        path (str): The JSON file.
+        offset (int): The byte offset to resume from, as yielded with
+            a previous record; 0 to start from the beginning.
+        read_size (int): The number of bytes read at a time.
+
+    Yields:
+        tuple: Each record and the byte offset right after it.
+
+    Raises:
+        ValueError: If the file is not a JSON object of records.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    # byte offset of buf[mark]
+    base, mark = offset, 0
+    started = offset > 0
+    eof = False
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            pos = 0
+            while True:
+                while pos < len(buf) and buf[pos] in WHITESPACE:
+                    pos += 1
+                if pos == len(buf):
+                    break
+                if not started:
+                    if buf[pos] != '{':
+                        raise ValueError("{} is not a JSON object".format(
+                            path))
+                    started = True
+                    pos += 1
+                    continue
+                if buf[pos] == ',':
+                    pos += 1
+                    continue
+                if buf[pos] == '}':
+                    return
+                # only a value cut by the end of the buffer is read
+                # again; structural errors are raised right away
+                try:
+                    _, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError as error:
+                    if eof or not is_truncated(error):
+                        raise
+                    break
+                while end < len(buf) and buf[end] in WHITESPACE:
+                    end += 1
+                if end == len(buf):
+                    break
+                if buf[end] != ':':
+                    raise ValueError("{}: expected ':' at byte {}".format(
+                        path, base + len(buf[mark:end].encode('utf-8'))))
+                end += 1
+                while end < len(buf) and buf[end] in WHITESPACE:
+                    end += 1
+                try:
+                    record, end = decoder.raw_decode(buf, end)
+                except json.JSONDecodeError as error:
+                    if eof or not is_truncated(error):
+                        raise
+                    break
+                if not isinstance(record, dict):
+                    raise ValueError("{}: a record is not an object".format(
+                        path))
+                base += len(buf[mark:end].encode('utf-8'))
+                pos = mark = end
+                yield record, base
+            if eof:
+                raise ValueError("{}: unexpected end of file".format(path))
+            base += len(buf[mark:pos].encode('utf-8'))
+            buf, mark = buf[pos:], 0
+            data = f.read(read_size)
+            eof = not data
+            buf += utf8.decode(data, final=eof)
+
+
+def to_row(record: dict) -> Optional[dict]:
+    """
+    Maps a JSON store user to a users table row.
+
+    Args:
+        record (dict): The JSON store user.
+
+    Returns:
+        dict: The row, or None if the user cannot log in.
+    """
+    email = record.get('email')
+    password = record.get('_password')
+    if not isinstance(email, str) or not email \
+            or not isinstance(password, str) or not password:
+        return None
+    return {'email': email, 'hashed_password': legacy_sha256(password)}
+
+
+def read_checkpoint(path: str, source: str) -> Tuple[int, int]:
+    """
+    Reads the checkpoint of a previous run over the same source.
+
+    Returns:
+        tuple: The byte offset to resume from and the number of
+            records already processed, (0, 0) if there is none.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0, 0
+    if checkpoint.get('source') != os.path.abspath(source):
+        sys.exit("{} is a checkpoint of {}, use --restart".format(
+            path, checkpoint.get('source')))
+    return checkpoint['offset'], checkpoint['processed']
+
+
+def write_checkpoint(path: str, source: str, offset: int,
+                     processed: int) -> None:
+    """
+    Atomically records the progress of the migration.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'source': os.path.abspath(source), 'offset': offset,
+                   'processed': processed}, f)
+    os.replace(tmp, path)
+
+
+def migrate_users(engine: Engine, source: str, checkpoint: str,
+                  batch_size: int = 1000) -> dict:
+    """
+    Migrates the users of a JSON store, resuming from the checkpoint.
+
+    Args:
+        engine (Engine): The database engine.
+        source (str): The JSON store file.
+        checkpoint (str): The checkpoint file.
+        batch_size (int): The number of records per transaction.
+
+    Returns:
+        dict: The counts of processed, inserted and skipped records.
+    """
+    migrations.migrate(engine)
+    offset, processed = read_checkpoint(checkpoint, source)
+    statement = User.__table__.insert().prefix_with('OR IGNORE')
+    stats = {'processed': processed, 'inserted': 0, 'skipped': 0}
+    batch = []
+    pending = 0
+
+    def flush(offset: int) -> None:
+        if batch:
+            with engine.begin() as conn:
+                stats['inserted'] += conn.execute(statement, batch).rowcount
+            batch.clear()
+        stats['processed'] += pending
+        write_checkpoint(checkpoint, source, offset, stats['processed'])
+
+    for record, offset in iter_records(source, offset):
+        row = to_row(record)
+        if row is None:
+            stats['skipped'] += 1
+        else:
+            batch.append(row)
+        pending += 1
+        if pending == batch_size:
+            flush(offset)
+            pending = 0
+    flush(offset)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Migrate a .db_User.json store into the users table.")
+    parser.add_argument('json_file', nargs='?', default='.db_User.json')
+    parser.add_argument('--db', default='sqlite:///a.db',
+                        help="database URL (default: sqlite:///a.db)")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="records per transaction (default: 1000)")
+    parser.add_argument('--checkpoint',
+                        help="checkpoint file (default: <json_file>.ckpt)")
+    parser.add_argument('--restart', action='store_true',
+                        help="ignore the checkpoint and start over")
+    args = parser.parse_args()
+    checkpoint = args.checkpoint or args.json_file + '.ckpt'
+    if args.restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    stats = migrate_users(create_engine(args.db), args.json_file,
+                          checkpoint, max(args.batch_size, 1))
+    print("{processed} records processed: {inserted} users inserted, "
+          "{skipped} skipped".format(**stats))
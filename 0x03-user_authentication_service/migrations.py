@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations for the user database.
+"""
+from datetime import datetime, timedelta
+from os import getenv
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer,
+                        MetaData, String, Table, func, select)
+from sqlalchemy.engine import Connection, Engine
+
+# Tracks the schema version; kept outside of Base.metadata so that
+# resetting the user tables leaves it alone
+metadata = MetaData()
+schema_version = Table(
+    'schema_version', metadata,
+    Column('version', Integer, nullable=False),
+)
+
+
+class MigrationError(Exception):
+    """
+    Raised when a migration cannot be applied to the existing data.
+    """
+
+
+# The tables are defined as each migration leaves them, not taken from
+# the models, so that later model changes never alter a past step.
+
+def _users_v1(meta: MetaData) -> Table:
+    """
+    Defines the users table of version 1.
+    """
+    return Table(
+        'users', meta,
+        Column('id', Integer, primary_key=True),
+        Column('email', String(250), nullable=False),
+        Column('hashed_password', String(250), nullable=False),
+        Column('session_id', String(250), nullable=True),
+        Column('reset_token', String(250), nullable=True),
+    )
+
+
+def _users_v2(meta: MetaData) -> Table:
+    """
+    Defines the users table of version 2, with its indexes.
+    """
+    users = _users_v1(meta)
+    Index('ix_users_email', users.c.email, unique=True)
+    Index('ix_users_session_id', users.c.session_id)
+    Index('ix_users_reset_token', users.c.reset_token)
+    return users
+
+
+def _sessions_v3(meta: MetaData) -> Table:
+    """
+    Defines the sessions table of version 3, with its indexes.
+    """
+    return Table(
+        'sessions', meta,
+        Column('session_id', String(250), primary_key=True),
+        Column('user_id', Integer, ForeignKey('users.id'), nullable=False,
+               index=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('expires_at', DateTime, nullable=False, index=True),
+    )
+
+
+def _create_users(conn: Connection) -> None:
+    """
+    Creates the users table.
+    """
+    _users_v1(MetaData()).create(conn, checkfirst=True)
+
+
+def _index_users(conn: Connection) -> None:
+    """
+    Indexes the columns find_user_by filters on: email (unique),
+    session_id and reset_token. Tables created before the indexes
+    existed are upgraded here.
+
+    Raises:
+        MigrationError: If several users share an email.
+    """
+    users = _users_v2(MetaData())
+    duplicates = conn.execute(
+        select(users.c.email).group_by(users.c.email)
+        .having(func.count() > 1).order_by(users.c.email).limit(10)
+    ).scalars().all()
+    if duplicates:
+        raise MigrationError(
+            "cannot add the unique index on users.email, these emails "
+            "belong to several users: {}; merge or delete the duplicate "
+            "users, then migrate again".format(', '.join(duplicates)))
+    for index in users.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _create_sessions(conn: Connection) -> None:
+    """
+    Creates the sessions table and moves the sessions stored in
+    users.session_id into it, expiring SESSION_DURATION seconds
+    from now.
+    """
+    meta = MetaData()
+    users = _users_v2(meta)
+    sessions = _sessions_v3(meta)
+    sessions.create(conn, checkfirst=True)
+    now = datetime.utcnow()
+    expires_at = now + timedelta(
+        seconds=int(getenv('SESSION_DURATION', 86400)))
+    rows = [{'session_id': session_id, 'user_id': user_id,
+             'created_at': now, 'expires_at': expires_at}
+            for user_id, session_id in conn.execute(
+                select(users.c.id, users.c.session_id).where(
+                    users.c.session_id.isnot(None)))]
+    if rows:
+        conn.execute(sessions.insert(), rows)
+        conn.execute(users.update().values(session_id=None))
+
+
+# (version, description, upgrade) in order
+MIGRATIONS = [
+    (1, "create users table", _create_users),
+    (2, "index users email, session_id and reset_token", _index_users),
+    (3, "move sessions to their own table", _create_sessions),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn: Connection) -> int:
+    """
+    Returns the schema version of the database, 0 if never migrated.
+
+    Args:
+        conn (Connection): An open connection.
+
+    Returns:
+        int: The schema version.
+    """
+    metadata.create_all(conn)
+    version = conn.execute(select(schema_version.c.version)).scalar()
+    return version or 0
+
+
+def stamp(conn: Connection, version: int) -> None:
+    """
+    Records the schema version of the database.
+
+    Args:
+        conn (Connection): An open connection, in a transaction.
+        version (int): The version to record.
+    """
+    metadata.create_all(conn)
+    conn.execute(schema_version.delete())
+    conn.execute(schema_version.insert().values(version=version))
+
+
+def migrate(engine: Engine) -> int:
+    """
+    Applies the pending migrations, each in its own transaction.
+
+    Args:
+        engine (Engine): The database engine.
+
+    Returns:
+        int: The resulting schema version.
+
+    Raises:
+        MigrationError: If a migration cannot be applied; the steps
+            before it stay applied.
+    """
+    with engine.begin() as conn:
+        version = current_version(conn)
+    for target, _, upgrade in MIGRATIONS:
+        if target <= version:
+            continue
+        with engine.begin() as conn:
+            upgrade(conn)
+            stamp(conn, target)
+        version = target
+    return version
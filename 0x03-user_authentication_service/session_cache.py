@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Session Cache Module
+"""
+from collections import OrderedDict
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import Optional
+
+
+class SessionCache:
+    """
+    Bounded, thread-safe LRU cache mapping session IDs to users,
+    with a time to live on every entry.
+
+    The cache belongs to one process. A logout or a password change
+    handled by another worker process does not invalidate it, so there
+    a destroyed session would keep authenticating for up to the TTL.
+    With `verify` set, the owner re-checks on every hit that the
+    session still exists (a primary key lookup, no user load).
+
+    Environment:
+        SESSION_CACHE_SIZE: maximum number of sessions (default 10000).
+        SESSION_CACHE_TTL: seconds an entry stays valid (default 60).
+        SESSION_CACHE_VERIFY: set to 1 to re-check hits; defaults to
+            on when WEB_CONCURRENCY (gunicorn's worker count) is above 1.
+    """
+
+    def __init__(self, maxsize: int = None, ttl: float = None,
+                 verify: bool = None) -> None:
+        """
+        Initializes an empty cache.
+
+        Args:
+            maxsize (int): Maximum number of sessions kept, defaults to
+                SESSION_CACHE_SIZE or 10000; 0 disables the cache.
+            ttl (float): Seconds an entry stays valid, defaults to
+                SESSION_CACHE_TTL or 60.
+            verify (bool): Whether hits must be re-checked against the
+                database, see above.
+        """
+        if maxsize is None:
+            maxsize = int(getenv('SESSION_CACHE_SIZE', 10000))
+        if ttl is None:
+            ttl = float(getenv('SESSION_CACHE_TTL', 60))
+        if verify is None:
+            verify = getenv('SESSION_CACHE_VERIFY')
+            if verify is None:
+                verify = int(getenv('WEB_CONCURRENCY', 1)) > 1
+            else:
+                verify = verify.lower() in ('1', 'true', 'yes')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.verify = verify
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_id: str):
+        """
+        Looks a session up.
+
+        Args:
+            session_id (str): The session ID.
+
+        Returns:
+            The cached user, or None on a miss or an expired entry.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            user, expires = entry
+            if expires <= monotonic():
+                self._drop(session_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return user
+
+    def put(self, session_id: str, user, ttl: Optional[float] = None) -> None:
+        """
+        Caches the user of a session, evicting the least recently
+        used entry when full.
+
+        Args:
+            session_id (str): The session ID.
+            user: The user, with an `id` attribute.
+            ttl (float): Overrides the default time to live.
+        """
+        if self.maxsize <= 0:
+            return
+        expires = monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._drop(session_id)
+            self._entries[session_id] = (user, expires)
+            self._by_user.setdefault(user.id, set()).add(session_id)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, session_id: str) -> None:
+        """
+        Removes a session from the cache.
+        """
+        with self._lock:
+            self._drop(session_id)
+
+    def invalidate_user(self, user_id: int) -> None:
+        """
+        Removes every session of a user from the cache.
+        """
+        with self._lock:
+            for session_id in list(self._by_user.get(user_id, ())):
+                self._drop(session_id)
+
+    def clear(self) -> None:
+        """
+        Empties the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss metrics of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'size': len(self._entries), 'maxsize': self.maxsize,
+                    'verify': self.verify}
+
+    def _drop(self, session_id: str) -> None:
+        """
+        Removes an entry; the lock must be held.
+        """
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return
+        sessions = self._by_user.get(entry[0].id)
+        if sessions is not None:
+            sessions.discard(session_id)
+            if not sessions:
+                del self._by_user[entry[0].id]
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+SQLite engine profile: pragmas applied to every new connection, and
+retries with backoff for statements failing on a locked database.
+"""
+import asyncio
+import random
+import time
+from functools import wraps
+from os import getenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+# Setting -> (environment variable, default)
+PROFILE_SETTINGS = {
+    'journal_mode': ('SQLITE_JOURNAL_MODE', 'wal'),
+    'synchronous': ('SQLITE_SYNCHRONOUS', 'normal'),
+    'cache_size': ('SQLITE_CACHE_SIZE', -20000),
+    'mmap_size': ('SQLITE_MMAP_SIZE', 268435456),
+    'busy_timeout': ('SQLITE_BUSY_TIMEOUT', 5000),
+    'lock_retries': ('SQLITE_LOCK_RETRIES', 5),
+    'lock_backoff': ('SQLITE_LOCK_BACKOFF', 0.05),
+}
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+
+
+class SQLiteProfile:
+    """
+    Connection settings for a SQLite engine.
+
+    WAL journaling lets readers proceed while a writer commits, and
+    synchronous=NORMAL is durable against application crashes in that
+    mode. cache_size is in pages, or in KiB when negative; mmap_size is
+    in bytes and busy_timeout in milliseconds. A statement still failing
+    with "database is locked" is retried up to lock_retries times,
+    waiting lock_backoff seconds doubled on each attempt, with jitter.
+
+    Environment:
+        SQLITE_PROFILE: set to 0 to leave the SQLite defaults.
+        SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE,
+        SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT, SQLITE_LOCK_RETRIES,
+        SQLITE_LOCK_BACKOFF: the settings above.
+    """
+
+    def __init__(self, enabled: bool = None, **settings) -> None:
+        """
+        Initializes the profile; settings not given are read from the
+        environment.
+
+        Raises:
+            ValueError: If a setting is unknown or invalid.
+        """
+        unknown = set(settings) - set(PROFILE_SETTINGS)
+        if unknown:
+            raise ValueError("unknown settings: {}".format(sorted(unknown)))
+        if enabled is None:
+            enabled = getenv('SQLITE_PROFILE', '1').lower() not in (
+                '0', 'false', 'no')
+        self.enabled = enabled
+        for name, (variable, default) in PROFILE_SETTINGS.items():
+            value = settings.get(name)
+            if value is None:
+                value = getenv(variable, default)
+            setattr(self, name, type(default)(value))
+        self.journal_mode = self.journal_mode.lower()
+        self.synchronous = self.synchronous.lower()
+        if self.journal_mode not in JOURNAL_MODES:
+            raise ValueError("journal_mode must be one of {}".format(
+                JOURNAL_MODES))
+        if self.synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError("synchronous must be one of {}".format(
+                SYNCHRONOUS_LEVELS))
+
+    def apply(self, engine: Engine) -> None:
+        """
+        Applies the pragmas to every connection the engine opens.
+        Engines of other databases are left alone.
+
+        Args:
+            engine (Engine): The engine.
+        """
+        if self.enabled and engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', self._on_connect)
+
+    def _on_connect(self, dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA busy_timeout = {:d}".format(
+                self.busy_timeout))
+            cursor.execute("PRAGMA journal_mode = {}".format(
+                self.journal_mode))
+            cursor.execute("PRAGMA synchronous = {}".format(
+                self.synchronous))
+            cursor.execute("PRAGMA cache_size = {:d}".format(
+                self.cache_size))
+            cursor.execute("PRAGMA mmap_size = {:d}".format(self.mmap_size))
+        finally:
+            cursor.close()
+
+    def settings(self) -> dict:
+        """
+        Returns the profile settings.
+        """
+        return dict({name: getattr(self, name) for name in PROFILE_SETTINGS},
+                    enabled=self.enabled)
+
+
+def is_locked(error: OperationalError) -> bool:
+    """
+    Tells whether a database error is a transient lock conflict.
+    """
+    message = str(error.orig).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def retry_locked(method):
+    """
+    Retries a DB method failing on a locked database, following the
+    lock_retries and lock_backoff of the instance's `sqlite_profile`.
+    The session is rolled back before each new attempt.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profile = self.sqlite_profile
+        attempt = 0
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except OperationalError as error:
+                if not is_locked(error) or attempt >= profile.lock_retries:
+                    raise
+                self._session.rollback()
+                delay = profile.lock_backoff * (2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                attempt += 1
+    return wrapper
+
+
+def retry_locked_async(method):
+    """
+    Coroutine counterpart of retry_locked, for AsyncDB methods; each
+    attempt runs in its own session, so nothing needs rolling back.
+    """
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        profile = self.sqlite_profile
+        attempt = 0
+        while True:
+            try:
+                return await method(self, *args, **kwargs)
+            except OperationalError as error:
+                if not is_locked(error) or attempt >= profile.lock_retries:
+                    raise
+                delay = profile.lock_backoff * (2 ** attempt)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                attempt += 1
+    return wrapper
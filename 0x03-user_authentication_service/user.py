@@ -21,17 +21,17 @@ class User(Base):
     # Unique identifier for each user
     id = Column(Integer, primary_key=True)
     
-    # Email address of the user (required)
-    email = Column(String(250), nullable=False)
+    # Email address of the user (required, unique and indexed)
+    email = Column(String(250), nullable=False, unique=True, index=True)
     
     # Hashed password of the user (required)
     hashed_password = Column(String(250), nullable=False)
     
-    # Optional session ID for user session management
-    session_id = Column(String(250), nullable=True)
+    # Optional session ID for user session management (indexed)
+    session_id = Column(String(250), nullable=True, index=True)
     
-    # Optional reset token for password recovery
-    reset_token = Column(String(250), nullable=True)
+    # Optional reset token for password recovery (indexed)
+    reset_token = Column(String(250), nullable=True, index=True)
 
     def __repr__(self):
         """
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+User Session Module
+"""
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from user import Base
+
+
+class UserSession(Base):
+    """
+    UserSession class represents a login session of a user; a user
+    may have one per device.
+    """
+
+    # Name of the table in the database
+    __tablename__ = 'sessions'
+
+    # Session ID handed to the client as a cookie
+    session_id = Column(String(250), primary_key=True)
+
+    # Owner of the session (indexed, to find or destroy a user's sessions)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False,
+                     index=True)
+
+    # Creation time of the session (UTC)
+    created_at = Column(DateTime, nullable=False)
+
+    # Expiry time of the session (UTC, indexed, to purge expired rows)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the UserSession instance,
+        displaying the user ID.
+        """
+        return f"UserSession: user_id={self.user_id}"